@@ -0,0 +1,46 @@
+"""Микро-бенчмарк разбора строк лога ui_short.
+
+Запуск из корня репозитория:
+
+    python -m homework_1.benchmarks.bench_parser
+"""
+
+import re
+import timeit
+
+from ..log_analyzer import UiShortParser
+
+LINE = (
+    b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" '
+    b'200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+    b'"1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n'
+)
+NUMBER = 200000
+
+
+def legacy_parse(line):
+    line = line.decode("utf-8")
+    url = re.search(r" /(.*) H", line).group().strip().split(" ")[0]
+    request_time = re.search(r"([0-9][.])?[0-9]+$", line).group()
+    return url, request_time
+
+
+def lines_per_second(func):
+    return NUMBER / min(timeit.repeat(lambda: func(LINE), number=NUMBER, repeat=3))
+
+
+def main():
+    parser = UiShortParser()
+    results = {
+        "legacy re.search": lines_per_second(legacy_parse),
+        "UiShortParser.split": lines_per_second(parser.split),
+        "UiShortParser.match": lines_per_second(parser.match),
+        "UiShortParser.parse": lines_per_second(parser.parse),
+    }
+    baseline = results["legacy re.search"]
+    for name, speed in results.items():
+        print(f"{name:<22} {speed:>12,.0f} lines/sec  x{speed / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
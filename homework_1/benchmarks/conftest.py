@@ -0,0 +1,127 @@
+import json
+import os
+import resource
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from .log_generator import generate_log
+
+BENCH_LINES = int(os.environ.get("LOG_ANALYZER_BENCH_LINES", 200000))
+BENCH_URLS = int(os.environ.get("LOG_ANALYZER_BENCH_URLS", 5000))
+BENCH_JSON = os.environ.get("LOG_ANALYZER_BENCH_JSON")
+RSS_SAMPLE_INTERVAL = 0.01
+PAGE_KB = resource.getpagesize() // 1024
+RESULTS = []
+
+
+def max_rss(who):
+    return resource.getrusage(who).ru_maxrss
+
+
+def tree_rss(pid):
+    """Сумма RSS процесса pid и всех его потомков по /proc, в КБ (0 без /proc).
+    Общие после fork страницы учитываются в каждом процессе"""
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * PAGE_KB
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as f:
+                    pids += [int(child) for child in f.read().split()]
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def measure(func, *args):
+    """Выполняется в отдельном процессе: время работы func, RSS процесса до запуска,
+    пиковый RSS и пик суммарного RSS дерева процессов. Процесс форкается от pytest,
+    так что пики включают унаследованные от него страницы (их показывает RSS до
+    запуска). Пиковый RSS - наибольший из процесса и его завершенных дочерних
+    процессов (воркеров --workers) по отдельности, а RSS дерева - сумма по процессу
+    и всем потомкам, снимаемая каждые RSS_SAMPLE_INTERVAL секунд"""
+    start_rss = max_rss(resource.RUSAGE_SELF)
+    peak_tree = [tree_rss(os.getpid())]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(RSS_SAMPLE_INTERVAL):
+            peak_tree[0] = max(peak_tree[0], tree_rss(os.getpid()))
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        func(*args)
+    finally:
+        elapsed = time.perf_counter() - started
+        done.set()
+        sampler.join()
+    peak_rss = max(max_rss(resource.RUSAGE_SELF), max_rss(resource.RUSAGE_CHILDREN))
+    return elapsed, start_rss, peak_rss, peak_tree[0] or None
+
+
+@pytest.fixture(scope="session")
+def plain_log(tmp_path_factory):
+    path = tmp_path_factory.mktemp("log") / "nginx-access-ui.log-20170630"
+    return generate_log(path, BENCH_LINES, BENCH_URLS)
+
+
+@pytest.fixture(scope="session")
+def gz_log(tmp_path_factory):
+    path = tmp_path_factory.mktemp("log") / "nginx-access-ui.log-20170630.gz"
+    return generate_log(path, BENCH_LINES, BENCH_URLS, compress=True)
+
+
+@pytest.fixture()
+def bench(request):
+    """Замеряет стадию в свежем процессе, чтобы в пиковый RSS не попадали
+    предыдущие стадии (но попадает унаследованный от pytest RSS, см. measure)"""
+
+    def run(stage, func, *args, lines=BENCH_LINES):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            elapsed, start_rss, peak_rss, tree_peak = executor.submit(
+                measure, func, *args
+            ).result()
+        RESULTS.append(
+            {
+                "name": request.node.name,
+                "stage": stage,
+                "seconds": elapsed,
+                "lines_per_sec": lines / elapsed if lines else None,
+                "start_rss_mb": start_rss / 1024,
+                "peak_rss_mb": peak_rss / 1024,
+                "tree_rss_mb": tree_peak / 1024 if tree_peak else None,
+            }
+        )
+        return elapsed
+
+    return run
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not RESULTS:
+        return
+    terminalreporter.section(f"log_analyzer benchmarks ({BENCH_LINES} lines)")
+    terminalreporter.write_line(
+        f"{'name':<50} {'stage':<10} {'seconds':>9} {'lines/sec':>12} "
+        f"{'start RSS, MB':>14} {'peak RSS, MB':>13} {'tree RSS, MB':>13}"
+    )
+    for result in RESULTS:
+        speed = result["lines_per_sec"]
+        tree = result["tree_rss_mb"]
+        terminalreporter.write_line(
+            f"{result['name']:<50} {result['stage']:<10} {result['seconds']:>9.3f} "
+            f"{format(speed, ',.0f') if speed else '-':>12} "
+            f"{result['start_rss_mb']:>14.1f} {result['peak_rss_mb']:>13.1f} "
+            f"{format(tree, '.1f') if tree else '-':>13}"
+        )
+    if BENCH_JSON:
+        with open(BENCH_JSON, "w") as f:
+            json.dump({"lines": BENCH_LINES, "results": RESULTS}, f, indent=4)
@@ -0,0 +1,100 @@
+"""Генератор синтетических логов nginx в формате ui_short.
+
+Популярность url распределена по Ципфу, время запроса - логнормально,
+часть строк можно сделать нераспознаваемыми. Запуск из корня репозитория:
+
+    python -m homework_1.benchmarks.log_generator ./log --lines 1000000 --urls 50000 --gzip
+"""
+
+import argparse
+import gzip
+import os
+import random
+from datetime import datetime, timedelta
+
+LINE = (
+    '{ip} -  - [{time_local}] "{method} {url} HTTP/1.1" 200 {size} "-" "{agent}" "-" '
+    '"{request_id}" "{user}" {request_time:.3f}\n'
+)
+METHODS = ("GET", "GET", "GET", "POST", "HEAD")
+AGENTS = (
+    "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0",
+    "python-requests/2.13.0",
+    "Go-http-client/1.1",
+)
+URL_TEMPLATES = (
+    "/api/v2/banner/{id}",
+    "/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28",
+    "/api/1/photogenic_banners/list/?server_name=WIN7RB{id}",
+    "/export/appinstall_raw/2017-06-{day:02d}/",
+    "/api/v2/slot/{id}/groups",
+)
+
+
+def make_urls(count, rng):
+    return [
+        rng.choice(URL_TEMPLATES).format(id=rng.randrange(10**7), day=i % 30 + 1)
+        for i in range(count)
+    ]
+
+
+def generate_lines(lines, urls=1000, bad_ratio=0.0, seed=0):
+    """Строки лога: url выбираются с весами по закону Ципфа"""
+    rng = random.Random(seed)
+    url_list = make_urls(urls, rng)
+    weights = [1 / rank for rank in range(1, urls + 1)]
+    start = datetime(2017, 6, 30)
+    batch = 10000
+    for offset in range(0, lines, batch):
+        size = min(batch, lines - offset)
+        for i, url in enumerate(rng.choices(url_list, weights, k=size)):
+            if bad_ratio and rng.random() < bad_ratio:
+                yield "broken line without request\n"
+                continue
+            time_local = start + timedelta(seconds=(offset + i) // 100)
+            yield LINE.format(
+                ip=f"1.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}",
+                time_local=time_local.strftime("%d/%b/%Y:%H:%M:%S +0300"),
+                method=rng.choice(METHODS),
+                url=url,
+                size=rng.randrange(100, 100000),
+                agent=rng.choice(AGENTS),
+                request_id=f"{offset + i}-{rng.randrange(10**10)}",
+                user=f"{rng.randrange(16**9):09x}",
+                request_time=rng.lognormvariate(-1.5, 1),
+            )
+
+
+def generate_log(path, lines, urls=1000, compress=False, bad_ratio=0.0, seed=0):
+    opener = gzip.open if compress else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        f.writelines(generate_lines(lines, urls, bad_ratio, seed))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic ui_short log generator")
+    parser.add_argument("log_dir", help="Directory to write the log to")
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--urls", type=int, default=1000, help="URL cardinality")
+    parser.add_argument("--gzip", action="store_true", help="Write a .gz log")
+    parser.add_argument("--bad-ratio", type=float, default=0.0)
+    parser.add_argument("--date", default="20170630")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    os.makedirs(args.log_dir, exist_ok=True)
+    name = f"nginx-access-ui.log-{args.date}" + (".gz" if args.gzip else "")
+    path = generate_log(
+        os.path.join(args.log_dir, name),
+        args.lines,
+        args.urls,
+        args.gzip,
+        args.bad_ratio,
+        args.seed,
+    )
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
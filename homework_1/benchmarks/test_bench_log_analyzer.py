@@ -0,0 +1,73 @@
+"""Бенчмарки стадий log_analyzer: чтение, разбор, агрегация, отрисовка.
+
+Не входят в обычный прогон тестов, запуск из корня репозитория:
+
+    pytest homework_1/benchmarks
+    LOG_ANALYZER_BENCH_LINES=5000000 LOG_ANALYZER_BENCH_JSON=bench.json pytest homework_1/benchmarks
+"""
+
+import os
+import shutil
+from collections import deque
+
+import pytest
+
+from ..log_analyzer import (
+    aggregate_parallel,
+    build_report,
+    log_finder,
+    log_reader,
+    render_report,
+    ExactQuantiles,
+    TDigest,
+)
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "report.html")
+
+
+def read_stage(file):
+    deque(log_reader(file), maxlen=0)
+
+
+def parse_stage(file):
+    deque(log_finder(file), maxlen=0)
+
+
+def aggregate_stage(file, workers, backend):
+    aggregate_parallel(file, workers, backend)
+
+
+def render_stage(workdir, report):
+    os.chdir(workdir)
+    render_report("20170630", report)
+
+
+@pytest.mark.parametrize("log", ["plain_log", "gz_log"])
+def test_read(bench, request, log):
+    bench("read", read_stage, request.getfixturevalue(log))
+
+
+@pytest.mark.parametrize("log", ["plain_log", "gz_log"])
+def test_parse(bench, request, log):
+    bench("parse", parse_stage, request.getfixturevalue(log))
+
+
+@pytest.mark.parametrize(
+    "log, workers, backend",
+    [
+        ("plain_log", 1, ExactQuantiles),
+        ("plain_log", 1, TDigest),
+        ("plain_log", 4, ExactQuantiles),
+        ("gz_log", 1, ExactQuantiles),
+        ("gz_log", 4, ExactQuantiles),
+    ],
+)
+def test_aggregate(bench, request, log, workers, backend):
+    bench("aggregate", aggregate_stage, request.getfixturevalue(log), workers, backend)
+
+
+def test_render(bench, plain_log, tmp_path):
+    shutil.copy(TEMPLATE, tmp_path)
+    report = build_report(aggregate_parallel(plain_log, 1), report_size=1000)
+    bench("render", render_stage, tmp_path, report, lines=None)
+    assert (tmp_path / "report-20170630.html").exists()
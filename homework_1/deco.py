@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from functools import update_wrapper
+import asyncio
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+from functools import reduce, update_wrapper
+import inspect
+import sys
+import threading
+import time
 
 
 def disable(func):
@@ -15,68 +22,400 @@ def disable(func):
     return func
 
 
-def decorator():
+def decorator(dec):
     """
     Декоратор наследует строки документации
     и прочее из функции, которую он украшает
     Decorate a decorator so that it inherits the docstrings
     and stuff from the function it's decorating.
     """
-    return
 
+    def decorate(func):
+        return inherit(dec(func), func)
 
-callcounts = {}
+    return update_wrapper(decorate, dec)
 
 
+def inherit(wrapper, func):
+    """update_wrapper, при котором собственные атрибуты wrapper (calls,
+    cache_info, stats) не затираются одноименными атрибутами func. Словарь func
+    только копируется, а __wrapped__ сохраняется для inspect.signature и unwrap.
+    Внешняя обертка над countcalls подписывается на его счетчик calls"""
+    own = dict(wrapper.__dict__)
+    update_wrapper(wrapper, func)
+    wrapper.__dict__.update(own)
+    if "calls" not in own and hasattr(func, "_calls_holders"):
+        func._calls_holders.append(wrapper)
+    return wrapper
+
+
+class Switch:
+    """Флаг, который можно переключать на лету: Switch.enabled"""
+
+    __slots__ = ("enabled",)
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+
+PROFILING = Switch(False)
+TRACING = Switch(True)
+LOCAL = threading.local()
+
+
+@decorator
 def countcalls(func):
-    """Декоратор, подсчитывающий вызовы декорируемой функции
+    """Декоратор, подсчитывающий вызовы декорируемой функции в атрибуте calls.
+    calls - обычный int, его обновляет сама обертка и внешние обертки над ней
     Decorator that counts calls made to the function decorated."""
 
-    def wrapper(*args):
+    holders = []
+
+    def wrapper(*args, **kwargs):
+        for holder in holders:
+            holder.calls += 1
+        return func(*args, **kwargs)
+
+    wrapper.calls = 0
+    wrapper._calls_holders = holders
+    holders.append(wrapper)
+    return wrapper
+
+
+class CallStats:
+    """Статистика profile по функции: число вызовов, полное время (с вложенными
+    вызовами, рекурсия не считается дважды) и собственное время в наносекундах.
+    Вызовы из разных потоков суммируются"""
+
+    __slots__ = ("name", "calls", "total_ns", "self_ns")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total_ns = 0
+        self.self_ns = 0
+
+
+PROFILED = []
+
+
+def profile(func):
+    """Профилирует вызовы: статистика CallStats в wrapper.stats и в PROFILED.
+    Собственное время - полное за вычетом времени вложенных профилируемых функций.
+    Стек вложенных вызовов и глубина рекурсии ведутся отдельно в каждом потоке.
+    Пока PROFILING.enabled ложно, обертка только передает вызов дальше"""
+    stats = CallStats(func.__qualname__)
+
+    def wrapper(*args, **kwargs):
+        if not PROFILING.enabled:
+            return func(*args, **kwargs)
         try:
-            callcounts[func] += 1
-        except KeyError:
-            callcounts[func] = 1
+            stack, active = LOCAL.profile, LOCAL.profile_active
+        except AttributeError:
+            stack, active = LOCAL.profile, LOCAL.profile_active = [], {}
+        stack.append(0)
+        depth = active.get(stats, 0)
+        active[stats] = depth + 1
+        start = time.perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
         finally:
-            return func(*args)
-
+            elapsed = time.perf_counter_ns() - start
+            stats.calls += 1
+            stats.self_ns += elapsed - stack.pop()
+            if depth:
+                active[stats] = depth
+            else:
+                del active[stats]
+                stats.total_ns += elapsed
+            if stack:
+                stack[-1] += elapsed
+
+    inherit(wrapper, func)
+    wrapper.stats = stats
+    PROFILED.append(stats)
     return wrapper
 
 
-def memo(func):
+def profile_report():
+    """Статистика всех профилируемых функций по убыванию собственного времени"""
+    return sorted(PROFILED, key=lambda stats: stats.self_ns, reverse=True)
+
+
+CacheInfo = namedtuple("CacheInfo", "hits misses evictions maxsize currsize")
+FAST_TYPES = {int, str}
+KWARGS_MARK = object()
+MISSING = object()
+
+
+def make_key(args, kwargs):
+    """Ключ кэша по аргументам. Единственный аргумент типа int или str
+    сам служит ключом, без упаковки в кортеж"""
+    if kwargs:
+        return args + (KWARGS_MARK,) + tuple(kwargs.items())
+    if len(args) == 1 and type(args[0]) in FAST_TYPES:
+        return args[0]
+    return args
+
+
+def freeze(value):
+    """Хешируемое представление list/tuple/set/dict (рекурсивно),
+    тип сохраняется в ключе, чтобы f([1]) и f((1,)) не совпадали"""
+    if isinstance(value, dict):
+        return dict, frozenset((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return type(value), frozenset(value)
+    return value
+
+
+def memo(func=None, maxsize=1024, ttl=None, threadsafe=False):
     """
-    кэширует
-    Memoize a function so that it caches all return values for
+    кэширует результаты в общем для всех вызовов кэше функции.
+    maxsize - число хранимых результатов (вытесняются давно не использованные,
+    None - без ограничения), ttl - время жизни результата в секундах.
+    Непригодные для хеширования list/dict/set приводятся к хешируемому виду,
+    иначе вызов идет мимо кэша. Статистика - в wrapper.cache_info(),
+    misses - число вычислений, ожидание чужого вычисления считается попаданием.
+    threadsafe=True - кэш под блокировкой, а одновременные вызовы с одним ключом
+    ждут одного вычисления (single-flight). Для async def функций одновременные
+    вызовы с одним ключом в одном event loop ждут одну общую задачу,
+    threadsafe=True для них - ValueError.
+    Memoize a function so that it caches return values for
     faster future lookups.
-    """
 
-    def wrapper(*args):
-        cache = {}
+    @memo
+    @memo(maxsize=128, ttl=60, threadsafe=True)
+    """
+    if func is None:
+        return lambda func: memo(func, maxsize, ttl, threadsafe)
+    coroutine = inspect.iscoroutinefunction(func)
+    if coroutine and threadsafe:
+        raise ValueError(
+            "threadsafe=True не поддерживается для async def: "
+            "вызовы в одном event loop и так ждут общую задачу"
+        )
+    cache = OrderedDict()
+    stats = {"hits": 0, "misses": 0, "evictions": 0}
+    inflight = {}
+    lock = threading.Lock()
+
+    def find(args, kwargs):
+        """(ключ, результат из кэша или MISSING), ключ None - аргументы не хешируются"""
+        key = make_key(args, kwargs)
         try:
-            return cache[args]
-        except KeyError:
-            cache[args] = result = func(*args)
-            return result
+            return key, get(key)
         except TypeError:
-            return func(*args)
-
+            pass
+        key = make_key(
+            freeze(args), {name: freeze(value) for name, value in kwargs.items()}
+        )
+        try:
+            return key, get(key)
+        except TypeError:
+            return None, MISSING
+
+    # без threadsafe=True кэш меняется без блокировки: ключ может исчезнуть
+    # (вытеснен или истек в другом потоке) между проверкой и изменением,
+    # поэтому KeyError здесь не ошибка
+    def get(key):
+        entry = cache.get(key)
+        if entry is not None:
+            result, expires = entry
+            if expires is None or expires > time.monotonic():
+                stats["hits"] += 1
+                if maxsize is not None:
+                    try:
+                        cache.move_to_end(key)
+                    except KeyError:
+                        pass
+                return result
+            if cache.pop(key, None) is not None:
+                stats["evictions"] += 1
+        return MISSING
+
+    def put(key, result):
+        cache[key] = result, None if ttl is None else time.monotonic() + ttl
+        if maxsize is not None and len(cache) > maxsize:
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                return
+            stats["evictions"] += 1
+
+    def plain_wrapper(*args, **kwargs):
+        key, result = find(args, kwargs)
+        if result is MISSING:
+            stats["misses"] += 1
+            result = func(*args, **kwargs)
+            if key is not None:
+                put(key, result)
+        return result
+
+    def threadsafe_wrapper(*args, **kwargs):
+        with lock:
+            key, result = find(args, kwargs)
+            if result is not MISSING:
+                return result
+            flight = inflight.get(key)
+            if flight is None:
+                stats["misses"] += 1
+                if key is not None:
+                    inflight[key] = Future()
+            else:
+                stats["hits"] += 1
+        if flight is not None:
+            return flight.result()
+        if key is None:
+            return func(*args, **kwargs)
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as error:
+            with lock:
+                inflight.pop(key).set_exception(error)
+            raise
+        with lock:
+            put(key, result)
+            inflight.pop(key).set_result(result)
+        return result
+
+    async def async_wrapper(*args, **kwargs):
+        key, result = find(args, kwargs)
+        if result is not MISSING:
+            return result
+        if key is None:
+            stats["misses"] += 1
+            return await func(*args, **kwargs)
+        task = inflight.get(key)
+        if task is None:
+            stats["misses"] += 1
+            task = inflight[key] = asyncio.ensure_future(func(*args, **kwargs))
+            task.add_done_callback(lambda task: finish(key, task))
+        else:
+            stats["hits"] += 1
+        return await asyncio.shield(task)
+
+    def finish(key, task):
+        """Убирает завершенную задачу из inflight и кэширует ее результат"""
+        inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            put(key, task.result())
+
+    def cache_info():
+        with lock:
+            return CacheInfo(
+                stats["hits"], stats["misses"], stats["evictions"], maxsize, len(cache)
+            )
+
+    def cache_clear():
+        with lock:
+            cache.clear()
+            stats.update(hits=0, misses=0, evictions=0)
+
+    if coroutine:
+        wrapper = async_wrapper
+    elif threadsafe:
+        wrapper = threadsafe_wrapper
+    else:
+        wrapper = plain_wrapper
+    inherit(wrapper, func)
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
     return wrapper
 
 
-def n_ary(func):
+ASSOCIATIVE_UFUNC_NAMES = (
+    "add",
+    "multiply",
+    "maximum",
+    "minimum",
+    "fmax",
+    "fmin",
+    "logical_and",
+    "logical_or",
+    "logical_xor",
+    "bitwise_and",
+    "bitwise_or",
+    "bitwise_xor",
+)
+ASSOCIATIVE_UFUNCS = None
+
+
+def ufunc_numpy(func, associative=False):
+    """Модуль numpy, если func - ассоциативный бинарный numpy ufunc, иначе None.
+    numpy здесь не импортируется: если его еще никто не импортировал,
+    func не может быть ufunc"""
+    global ASSOCIATIVE_UFUNCS
+    np = sys.modules.get("numpy")
+    if np is None or not isinstance(func, np.ufunc) or func.nin != 2:
+        return None
+    if ASSOCIATIVE_UFUNCS is None:
+        ASSOCIATIVE_UFUNCS = {getattr(np, name) for name in ASSOCIATIVE_UFUNC_NAMES}
+    return np if associative or func in ASSOCIATIVE_UFUNCS else None
+
+
+def n_ary(func=None, associative=False):
     """
     Given binary function f(x, y), return an n_ary function such
     that f(x, y, z) = f(x, f(y,z)), etc. Also allow f(x) = x.
+    Свертка справа налево идет циклом, без рекурсии.
+    associative=True - функция ассоциативна, можно сворачивать слева направо
+    через functools.reduce, associative="tree" - попарно деревом (порядок
+    аргументов сохраняется, выгодно, когда цена операции растет с размером
+    операндов). Для ассоциативных numpy ufunc (np.add, np.maximum, ...)
+    свертка идет одним вызовом ufunc.reduce.
+
+    @n_ary
+    @n_ary(associative=True)
     """
+    if func is None:
+        return lambda func: n_ary(func, associative)
+    np = ufunc_numpy(func, associative)
 
     def wrapper(x, *args):
-        return x if not args else func(x, func(*args))
-
-    return wrapper
-
-
-def trace():
+        if not args:
+            return x
+        if len(args) == 1:
+            return func(x, args[0])
+        if np is not None:
+            try:
+                values = np.asarray((x,) + args)
+                if values.dtype != object:
+                    # dtype как у операндов, иначе reduce повышает bool и
+                    # малые целые до int64 и результат расходится со сверткой
+                    return func.reduce(values, dtype=values.dtype)
+            except (ValueError, TypeError):
+                # нет цикла ufunc для этого dtype (np.logical_and над int)
+                pass
+        if associative == "tree":
+            return tree_reduce(func, (x,) + args)
+        if associative:
+            return reduce(func, args, x)
+        result = args[-1]
+        for value in reversed(args[:-1]):
+            result = func(value, result)
+        return func(x, result)
+
+    return inherit(wrapper, func)
+
+
+def tree_reduce(func, values):
+    """Попарная свертка: ((a, b), (c, d)), ... с сохранением порядка значений"""
+    values = list(values)
+    while len(values) > 1:
+        paired = [func(values[i], values[i + 1]) for i in range(0, len(values) - 1, 2)]
+        if len(values) % 2:
+            paired.append(values[-1])
+        values = paired
+    return values[0]
+
+
+def trace(indent, every=1, switch=TRACING):
     """Trace calls made to function decorated.
+    Глубина вложенности общая для всех трассируемых функций потока.
+    every - печатать только каждый every-й вызов верхнего уровня (вместе со всеми
+    вложенными), switch - флаг, которым трассировку можно выключить на лету.
 
     @trace("____")
     def fib(n):
@@ -95,7 +434,42 @@ def trace():
      <-- fib(3) == 3
 
     """
-    return
+
+    def decorate(func):
+        roots = 0
+
+        def wrapper(*args, **kwargs):
+            nonlocal roots
+            if not switch.enabled:
+                return func(*args, **kwargs)
+            depth = getattr(LOCAL, "depth", 0)
+            if not depth:
+                roots += 1
+                LOCAL.sampled = (roots - 1) % every == 0
+            if not LOCAL.sampled:
+                LOCAL.depth = depth + 1
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    LOCAL.depth = depth
+            prefix = indent * depth
+            call = ", ".join(
+                [repr(arg) for arg in args]
+                + [f"{name}={value!r}" for name, value in kwargs.items()]
+            )
+            call = f"{func.__name__}({call})"
+            print(f"{prefix} --> {call}")
+            LOCAL.depth = depth + 1
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                LOCAL.depth = depth
+            print(f"{prefix} <-- {call} == {result}")
+            return result
+
+        return inherit(wrapper, func)
+
+    return decorate
 
 
 @memo
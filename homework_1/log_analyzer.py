@@ -1,12 +1,26 @@
 import gzip
+import heapq
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from array import array
 import json
-from itertools import groupby
 from pathlib import Path
 import logging
+import mmap
 import re
-from string import Template
+import tempfile
 import os.path
+import pickle
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
 
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
@@ -19,13 +33,81 @@ import os.path
 FORMAT = "[%(asctime)s] %(levelname).1s %(message)s"
 logging.basicConfig(format=FORMAT, filename="", level=logging.INFO)
 
-config = {"REPORT_SIZE": 1000, "REPORT_DIR": "./reports", "LOG_DIR": "./log"}
+config = {
+    "REPORT_SIZE": 1000,
+    "REPORT_DIR": "./reports",
+    "LOG_DIR": "./log",
+    "QUANTILE_BACKEND": "exact",
+    "STATE_FILE": None,
+    "ARCHIVE_DIR": None,
+    "SNAPSHOT_FILE": "./snapshot.json",
+    "SNAPSHOT_INTERVAL": 10,
+    "URL_NORMALIZATION": None,
+}
 FILE_DIR = os.path.dirname(__file__)
+
+
+def log_date(value):
+    """Дата для --date-from/--date-to в формате YYYYMMDD, как в именах логов"""
+    try:
+        if not re.fullmatch(r"[0-9]{8}", value):
+            raise ValueError(value)
+        datetime.strptime(value, "%Y%m%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Дата должна быть в формате YYYYMMDD: {value}"
+        )
+    return value
+
+
 parser = argparse.ArgumentParser(description="Log parser")
 parser.add_argument("--config", dest="config", default=config, help="Path to config")
-args = parser.parse_args()
+parser.add_argument(
+    "--workers", dest="workers", type=int, default=1, help="Number of parser processes"
+)
+parser.add_argument(
+    "--from-archive",
+    dest="archive",
+    default=None,
+    help="Render report from a columnar .npz archive instead of parsing logs",
+)
+parser.add_argument(
+    "--date-from",
+    dest="date_from",
+    type=log_date,
+    default=None,
+    help="First log date, YYYYMMDD",
+)
+parser.add_argument(
+    "--date-to",
+    dest="date_to",
+    type=log_date,
+    default=None,
+    help="Last log date, YYYYMMDD",
+)
+parser.add_argument(
+    "--follow",
+    dest="follow",
+    action="store_true",
+    help="Tail the current log and emit rolling 1/5/15-minute JSON snapshots",
+)
+# при импорте модуля (тесты, бенчмарки) аргументы командной строки не наши
+args = parser.parse_args() if __name__ == "__main__" else parser.parse_args([])
 
 LOGGER = logging.getLogger(__name__)
+COLUMN_TYPES = {"url": str, "count": np.int64}
+NUMBER_SEGMENT_RE = re.compile(r"(?<=/)[0-9]+(?=/|$|\?)")
+UUID_SEGMENT_RE = re.compile(
+    r"(?<=/)[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$|\?)"
+)
+LOG_NAME_RE = re.compile(r"^nginx-access-ui\.log-(?P<date>[0-9]{8})(?P<gz>\.gz)?$")
+READ_BLOCK_SIZE = 1024 * 1024
+READ_QUEUE_SIZE = 8
+RENDER_CHUNK_ROWS = 1000
+ERRORS_SAMPLE_SIZE = 10
+ERRORS_SUMMARY_EVERY = 100000
+ERRORS_MIN_LINES = 1000
+TEMPLATE_PLACEHOLDER = "$table_json"
 
 
 def get_config():
@@ -37,26 +119,67 @@ def get_config():
         return config
 
 
-def grouper(item):
-    return item["url"]
+def iter_logs(log_dir):
+    """Отдает (путь, дата, сжат ли) для каждого лога в каталоге за один проход"""
+    with os.scandir(log_dir) as entries:
+        for entry in entries:
+            match = LOG_NAME_RE.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            date = match.group("date")
+            try:
+                datetime.strptime(date, "%Y%m%d")
+            except ValueError:
+                continue
+            yield Path(entry.path), date, bool(match.group("gz"))
+
+
+@lru_cache(maxsize=16)
+def find_latest_log(log_dir, mtime_ns=None):
+    """Ищет за один проход по каталогу самый свежий лог (plain или .gz).
+    mtime_ns каталога входит в ключ кэша: пока файлы в каталоге не добавляли
+    и не удаляли, повторный поиск берется из кэша"""
+    latest = None
+    for path, date, gz in iter_logs(log_dir):
+        if latest is None or date > latest[1] or (date == latest[1] and not gz):
+            latest = (path, date)
+    return latest
+
+
+def find_logs(log_dir, date_from=None, date_to=None):
+    """Логи за диапазон дат включительно, {дата: путь} по возрастанию даты.
+    Если за день есть и plain, и .gz, берется plain"""
+    logs = {}
+    for path, date, gz in iter_logs(log_dir):
+        if (date_from and date < date_from) or (date_to and date > date_to):
+            continue
+        if date not in logs or not gz:
+            logs[date] = path
+    return dict(sorted(logs.items()))
 
 
 def get_log_file():
     result_config = get_config()
-    path = Path(result_config["LOG_DIR"])
-    logs = [file for file in path.glob("*") if str(file).find("nginx-access-ui.log-")]
-    log_file = max(logs)
-    date = str(log_file).split("-")[-1].split(".")[0]
-    LOGGER.info(f"Последний файл с логами {max(logs)}")
-    return log_file, date
+    log_dir = result_config["LOG_DIR"]
+    try:
+        latest = find_latest_log(log_dir, os.stat(log_dir).st_mtime_ns)
+    except FileNotFoundError:
+        LOGGER.error(f"Каталог с логами {log_dir} не найден")
+        return None, None
+    if latest is None:
+        LOGGER.error(f"В каталоге {log_dir} нет логов")
+        return None, None
+    LOGGER.info(f"Последний файл с логами {latest[0]}")
+    return latest
 
 
-def log_reader(file):
+def log_reader(file, start=0, end=None):
+    """Отдает строки лога как bytes без перевода строки, не декодируя их"""
     try:
-        reader = gzip.open if str(file).endswith(".gz") else open
-        with reader(file, "rt", encoding="utf-8") as f:
-            for line in f:
-                yield line
+        if str(file).endswith(".gz"):
+            yield from split_blocks(gzip_blocks(file))
+        else:
+            yield from mmap_reader(file, start, end)
     except TypeError:
         LOGGER.error("Файл с логами не передан")
         return None
@@ -65,23 +188,204 @@ def log_reader(file):
         return None
 
 
-def log_finder(file):
-    exeptions_counter = 0
-    line_counter = 0
-    for line in log_reader(file):
+def mmap_reader(file, start=0, end=None):
+    """Читает строки несжатого лога, начинающиеся в диапазоне байт [start, end),
+    срезами отображенного в память файла"""
+    with open(file, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            end = size if end is None else min(end, size)
+            find = mm.find
+            position = start
+            while position < end:
+                newline = find(b"\n", position)
+                if newline == -1:
+                    newline = size
+                yield mm[position:newline]
+                position = newline + 1
+
+
+def gzip_blocks(file, block_size=READ_BLOCK_SIZE, queue_size=READ_QUEUE_SIZE):
+    """Распаковывает .gz в отдельном потоке (zlib отпускает GIL) и отдает большие
+    блоки через ограниченную очередь, пока вызывающий код разбирает предыдущие"""
+    blocks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            with gzip.open(file, "rb") as f:
+                while put(block := f.read(block_size)) and block:
+                    pass
+        except BaseException as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, name="gzip-reader", daemon=True)
+    producer.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, BaseException):
+                raise block
+            if not block:
+                break
+            yield block
+    finally:
+        stop.set()
+        producer.join()
+
+
+@contextmanager
+def decompressed(file):
+    """Распаковывает .gz во временный файл, который можно отобразить в память
+    и разбирать по чанкам в нескольких процессах"""
+    with tempfile.NamedTemporaryFile(prefix="log_analyzer-", suffix=".log") as tmp:
+        with gzip.open(file, "rb") as f:
+            shutil.copyfileobj(f, tmp, READ_BLOCK_SIZE)
+        tmp.flush()
+        yield tmp.name
+
+
+def split_blocks(blocks):
+    """Нарезает поток больших блоков байт на строки"""
+    tail = b""
+    for block in blocks:
+        lines = (tail + block).split(b"\n")
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def get_chunks(file, workers, start=0, end=None):
+    """Делит диапазон байт [start, end) несжатого лога на чанки,
+    выровненные по границам строк"""
+    end = os.path.getsize(file) if end is None else end
+    bounds = [start]
+    with open(file, "rb") as f:
+        for i in range(1, workers):
+            f.seek(max(start + (end - start) * i // workers, bounds[-1]))
+            if f.tell() > start:
+                f.seek(f.tell() - 1)
+                f.readline()
+            bounds.append(min(f.tell(), end))
+    bounds.append(end)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+class UiShortParser:
+    """Разбирает строку лога (bytes) в формате ui_short в пару (url, request_time).
+    Сначала пробует быстрый разбор через поиск кавычек и последнего пробела,
+    при неудаче откатывается на регулярное выражение"""
+
+    pattern = re.compile(
+        rb'"[A-Z]+ (?P<url>/[^" ]*)[^"]*".*\s(?P<request_time>[0-9]+(?:\.[0-9]+)?)\s*$'
+    )
+    request_time = re.compile(rb"[0-9]+(?:\.[0-9]+)?")
+
+    def parse(self, line):
+        try:
+            return self.split(line)
+        except ValueError:
+            return self.match(line)
+
+    def split(self, line):
+        start = line.index(b'"') + 1
+        method, url, protocol = line[start : line.index(b'"', start)].split(b" ")
+        if not url.startswith(b"/"):
+            raise ValueError(f"Некорректный url: {url!r}")
+        request_time = line[line.rindex(b" ") + 1 :].rstrip()
+        if not self.request_time.fullmatch(request_time):
+            raise ValueError(f"Некорректный request_time: {request_time!r}")
+        return url.decode("utf-8"), float(request_time)
+
+    def match(self, line):
+        match = self.pattern.search(line)
+        if match is None:
+            raise ValueError(f"Строка не соответствует формату ui_short: {line!r}")
+        return match.group("url").decode("utf-8"), float(match.group("request_time"))
+
+
+class TooManyParseErrors(ValueError):
+    """Большую часть лога не удалось разобрать, статистика по нему недостоверна"""
+
+
+class ParseErrors:
+    """Учет нераспознанных строк лога: считает строки, пропущенные через count,
+    пишет в лог первые sample_size примеров и сводку раз в summary_every ошибок.
+    По ходу чтения долю ошибок проверяет только начиная с min_lines строк,
+    чтобы не прерываться на первой же плохой строке, в конце - всегда"""
+
+    def __init__(
+        self,
+        sample_size=ERRORS_SAMPLE_SIZE,
+        summary_every=ERRORS_SUMMARY_EVERY,
+        min_lines=ERRORS_MIN_LINES,
+    ):
+        self.sample_size = sample_size
+        self.summary_every = summary_every
+        self.min_lines = min_lines
+        self.lines = 0
+        self.errors = 0
+        self.examples = []
+
+    def count(self, lines):
+        for self.lines, line in enumerate(lines, self.lines + 1):
+            yield line
+
+    def add(self, line, error):
+        self.errors += 1
+        if len(self.examples) < self.sample_size:
+            self.examples.append(line)
+            LOGGER.warning(f"Не удалось разобрать строку {self.lines}: {error}")
+        elif self.errors % self.summary_every == 0:
+            self.log_summary()
+
+    def too_many(self):
+        return self.lines >= self.min_lines and not check_errors_percent(
+            self.lines, self.errors
+        )
+
+    def finish(self):
+        """Итоговая проверка после чтения: TooManyParseErrors, если ошибок больше 50%"""
+        if not self.errors:
+            return
+        self.log_summary()
+        if not check_errors_percent(self.lines, self.errors):
+            LOGGER.error("Большую часть анализируемого лога не удалось распарсить")
+            raise TooManyParseErrors(
+                f"Нераспознанных строк: {self.errors} из {self.lines}"
+            )
+
+    def log_summary(self):
+        LOGGER.warning(f"Нераспознанных строк: {self.errors} из {self.lines}")
+
+
+def log_finder(file, start=0, end=None, line_parser=None, errors=None):
+    """Пары (url, request_time) из строк лога. Если нераспознанных строк больше
+    половины, чтение прерывается и в конце бросается TooManyParseErrors"""
+    parse = (line_parser or UiShortParser()).parse
+    errors = ParseErrors() if errors is None else errors
+    for line in errors.count(log_reader(file, start, end)):
         try:
-            url = re.search(r" /(.*) H", line).group().strip().split(" ")[0]
-            request_time = re.search(r"([0-9][.])?[0-9]+$", line).group()
-            line_counter += 1
-            yield url, request_time
-        except AttributeError:
-            exeptions_counter += 1
-            LOGGER.exception(AttributeError)
-        if not check_errors_percent(line_counter, exeptions_counter):
-            LOGGER.exception("Большую часть анализируемого лога не удалось распарсить")
-            LOGGER.exception("Прерываю")
-            break
-    return None
+            url, request_time = parse(line)
+        except ValueError as e:
+            errors.add(line, e)
+            if errors.too_many():
+                break
+            continue
+        yield url, request_time
+    errors.finish()
 
 
 def check_errors_percent(lines, exeptions_counter):
@@ -94,52 +398,477 @@ def check_errors_percent(lines, exeptions_counter):
         return None
 
 
-def log_analyzer(file):
+class ExactQuantiles:
+    """Точные квантили: хранит все времена запросов в array('d')"""
+
+    __slots__ = ("times",)
+    percentiles = ()
+
+    def __init__(self):
+        self.times = array("d")
+
+    def add(self, value):
+        self.times.append(value)
+
+    def merge(self, other):
+        self.times.extend(other.times)
+
+    def quantile(self, q):
+        return get_quantile(self.times, q)
+
+
+class TDigest:
+    """Приближенные квантили (merging t-digest) в ограниченной памяти:
+    не более compression центроидов и буфер из 10 * compression значений"""
+
+    __slots__ = ("compression", "means", "weights", "buffer", "min", "max")
+    percentiles = (90, 95, 99)
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.buffer = array("d")
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= 10 * self.compression:
+            self.compress()
+
+    def merge(self, other):
+        self.means = np.concatenate((self.means, other.means))
+        self.weights = np.concatenate((self.weights, other.weights))
+        self.buffer.extend(other.buffer)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+
+    def compress(self):
+        if self.buffer:
+            values = np.frombuffer(self.buffer, dtype=float)
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            self.means = np.concatenate((self.means, values))
+            self.weights = np.concatenate((self.weights, np.ones(len(values))))
+            self.buffer = array("d")
+        if not len(self.means):
+            return
+        order = np.argsort(self.means, kind="stable")
+        means, weights = self.means[order], self.weights[order]
+        q = (np.cumsum(weights) - weights / 2) / weights.sum()
+        # масштабирующая функция k1: у хвостов центроиды мельче, чем у медианы
+        k = np.floor(self.compression * (np.arcsin(2 * q - 1) / np.pi + 0.5))
+        starts = np.flatnonzero(np.diff(k, prepend=-1))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q):
+        self.compress()
+        total = self.weights.sum()
+        if not total:
+            return None
+        centers = np.cumsum(self.weights) - self.weights / 2
+        ranks = np.concatenate(([0], centers, [total]))
+        values = np.concatenate(([self.min], self.means, [self.max]))
+        return round(float(np.interp(q * total, ranks, values)), 3)
+
+
+QUANTILE_BACKENDS = {"exact": ExactQuantiles, "tdigest": TDigest}
+
+
+class UrlNormalizer:
+    """Сводит url к шаблону маршрута: отбрасывает query string, заменяет числовые
+    и uuid сегменты пути на {id} и {uuid}, затем применяет пользовательские правила
+    (regex, замена). Регулярные выражения компилируются один раз, результаты
+    кэшируются в LRU на cache_size url"""
+
+    def __init__(
+        self, strip_query=True, template_ids=True, rules=(), cache_size=100000
+    ):
+        self.strip_query = strip_query
+        self.template_ids = template_ids
+        self.rules = [tuple(rule) for rule in rules]
+        self.cache_size = cache_size
+        self.compiled_rules = [
+            (re.compile(pattern), replacement) for pattern, replacement in self.rules
+        ]
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def __reduce__(self):
+        return UrlNormalizer, (self.key[0], self.key[1], self.rules, self.cache_size)
+
+    @property
+    def key(self):
+        return self.strip_query, self.template_ids, tuple(self.rules)
+
+    def _normalize(self, url):
+        if self.strip_query:
+            url = url.partition("?")[0]
+        if self.template_ids:
+            url = UUID_SEGMENT_RE.sub("{uuid}", url)
+            url = NUMBER_SEGMENT_RE.sub("{id}", url)
+        for pattern, replacement in self.compiled_rules:
+            url = pattern.sub(replacement, url)
+        return url
+
+
+def get_normalizer(result_config):
+    settings = result_config["URL_NORMALIZATION"]
+    if settings is None or settings is False:
+        return None
+    return UrlNormalizer(
+        settings.get("STRIP_QUERY", True),
+        settings.get("TEMPLATE_IDS", True),
+        settings.get("RULES", ()),
+        settings.get("CACHE_SIZE", 100000),
+    )
+
+
+class UrlStats:
+    """Накопитель статистики запросов к одному url"""
+
+    __slots__ = ("count", "time_sum", "time_max", "quantiles")
+
+    def __init__(self, backend=ExactQuantiles):
+        self.count = 0
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        self.quantiles = backend()
+
+    def add(self, request_time):
+        self.count += 1
+        self.time_sum += request_time
+        if request_time > self.time_max:
+            self.time_max = request_time
+        self.quantiles.add(request_time)
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_sum += other.time_sum
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        self.quantiles.merge(other.quantiles)
+
+
+def aggregate(lines, stats=None, backend=ExactQuantiles, normalizer=None):
+    """Потоково собирает статистику по url из пар (url, request_time)"""
+    stats = {} if stats is None else stats
+    normalize = normalizer.normalize if normalizer is not None else None
+    for url, request_time in lines:
+        if normalize is not None:
+            url = normalize(url)
+        url_stats = stats.get(url)
+        if url_stats is None:
+            url_stats = stats[url] = UrlStats(backend)
+        url_stats.add(float(request_time))
+    return stats
+
+
+def merge_stats(stats, partial):
+    """Добавляет частичную статистику partial к stats"""
+    for url, url_stats in partial.items():
+        current = stats.get(url)
+        if current is None:
+            stats[url] = url_stats
+        else:
+            current.merge(url_stats)
+    return stats
+
+
+def aggregate_chunk(file, start, end, backend=ExactQuantiles, normalizer=None):
+    return aggregate(
+        log_finder(file, start, end), backend=backend, normalizer=normalizer
+    )
+
+
+def aggregate_parallel(
+    file, workers, backend=ExactQuantiles, start=0, end=None, normalizer=None
+):
+    """Разбирает лог в пуле процессов по чанкам и сливает результаты.
+    .gz сначала распаковывается во временный файл"""
+    if workers <= 1:
+        return aggregate_chunk(file, start, end, backend, normalizer)
+    if str(file).endswith(".gz"):
+        LOGGER.info(f"Распаковываю {file} во временный файл")
+        with decompressed(file) as plain_file:
+            return aggregate_parallel(
+                plain_file, workers, backend, normalizer=normalizer
+            )
+    chunks = get_chunks(file, workers, start, end)
+    LOGGER.info(f"Разбираю лог в {workers} процессах, чанков: {len(chunks)}")
+    stats = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(aggregate_chunk, file, start, end, backend, normalizer)
+            for start, end in chunks
+        ]
+        for future in futures:
+            merge_stats(stats, future.result())
+    return stats
+
+
+def top_stats(stats, report_size=None):
+    """report_size url с наибольшим time_sum по убыванию, через кучу без полной сортировки"""
+    if report_size is None:
+        return stats.items()
+    return heapq.nlargest(report_size, stats.items(), key=lambda item: item[1].time_sum)
+
+
+def build_report(stats, report_size=None):
+    total_requests_num = sum(url_stats.count for url_stats in stats.values())
+    total_requests_time = sum(url_stats.time_sum for url_stats in stats.values())
+    report = []
+    for url, url_stats in top_stats(stats, report_size):
+        count = url_stats.count
+        time_sum = round(url_stats.time_sum, 3)
+        line_data = {
+            "url": url,
+            "count": count,
+            "count_perc": get_count_perc(count, total_requests_num),
+            "time_sum": time_sum,
+            "time_perc": get_time_perc(time_sum, total_requests_time),
+            "time_avg": round(time_sum / count, 3),
+            "time_max": url_stats.time_max,
+            "time_med": url_stats.quantiles.quantile(0.5),
+        }
+        for percentile in url_stats.quantiles.percentiles:
+            line_data[f"time_p{percentile}"] = url_stats.quantiles.quantile(
+                percentile / 100
+            )
+        report.append(line_data)
+    return report
+
+
+def get_complete_size(file):
+    """Размер префикса несжатого лога, состоящего из целых строк"""
+    with open(file, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.rfind(b"\n") + 1
+
+
+def load_state(state_file):
     try:
-        table_json = []
-        report = []
-        total_requests_num = 0
-        total_requests_time = float(0)
-        for line in log_finder(file):
-            total_requests_num += 1
-            total_requests_time += float(line[1])
-            line_data = {"url": line[0], "count": 1, "time_sum": float(line[1])}
-            table_json.append(line_data)
+        with open(state_file, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        LOGGER.info(f"Файл состояния {state_file} не найден, начинаю с нуля")
+    except (pickle.UnpicklingError, EOFError, AttributeError):
+        LOGGER.error(f"Файл состояния {state_file} поврежден, начинаю с нуля")
+    return {"processed": {}, "current": None}
+
+
+@contextmanager
+def atomic_open(path, mode="w", **kwargs):
+    """Пишет во временный файл рядом с path и подменяет path только после
+    успешной записи, чтобы читатели никогда не видели файл наполовину"""
+    fd, tmp_name = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=f".{os.path.basename(path)}-",
+    )
+    try:
+        with open(fd, mode, **kwargs) as f:
+            yield f
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def save_state(state_file, state):
+    with atomic_open(state_file, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    LOGGER.info(f"Состояние сохранено в {state_file}")
+
+
+def is_current(state, file, backend=ExactQuantiles, normalizer=None):
+    """В state["current"] частичная статистика этого лога, собранная тем же
+    бэкендом и с той же нормализацией url"""
+    current = state.get("current")
+    normalizer_key = normalizer.key if normalizer is not None else None
+    return (
+        current is not None
+        and current["file"] == str(file)
+        and current["backend"] == backend.__name__
+        and current.get("normalizer") == normalizer_key
+    )
+
+
+def aggregate_incremental(
+    file, state, workers=1, backend=ExactQuantiles, normalizer=None
+):
+    """Дочитывает лог с сохраненного в state смещения и дополняет сохраненную
+    частичную статистику. Для .gz файла смещение - либо 0, либо весь файл.
+    Если лог не разобран (TooManyParseErrors), state не меняется"""
+    file_stat = os.stat(file)
+    normalizer_key = normalizer.key if normalizer is not None else None
+    current = state.get("current")
+    if (
+        is_current(state, file, backend, normalizer)
+        and current["inode"] == file_stat.st_ino
+        and current["offset"] <= file_stat.st_size
+    ):
+        stats, offset = current["stats"], current["offset"]
+    else:
+        stats, offset = {}, 0
+    if str(file).endswith(".gz"):
+        end = file_stat.st_size
+        if offset < end:
+            stats = aggregate_parallel(file, workers, backend, normalizer=normalizer)
+    else:
+        end = get_complete_size(file)
+        if offset < end:
+            LOGGER.info(f"Дочитываю лог с байта {offset} до {end}")
+            merge_stats(
+                stats,
+                aggregate_parallel(file, workers, backend, offset, end, normalizer),
+            )
+    if offset >= end:
+        LOGGER.info("Новых строк в логе нет")
+    state["current"] = {
+        "file": str(file),
+        "inode": file_stat.st_ino,
+        "backend": backend.__name__,
+        "normalizer": normalizer_key,
+        "offset": end,
+        "stats": stats,
+    }
+    state["processed"][str(file)] = end
+    return stats
+
+
+def is_processed(state, file, backend=ExactQuantiles, normalizer=None):
+    """Лог уже разобран до конца с теми же настройками: сохраненное смещение
+    равно размеру его целых строк"""
+    offset = state["processed"].get(str(file))
+    if offset is None or not is_current(state, file, backend, normalizer):
+        return False
+    if str(file).endswith(".gz"):
+        return offset == os.path.getsize(file)
+    return offset == get_complete_size(file)
+
+
+def report_path(date):
+    return "report-" + date + ".html"
+
+
+def aggregate_files(files, workers=1, backend=ExactQuantiles, normalizer=None):
+    """Агрегирует каждый файл целиком в своем процессе, список статистик по файлам.
+    Для файла, который не удалось прочитать или разобрать, вместо статистики None"""
+    if workers <= 1 or len(files) <= 1:
+        results = []
+        for file in files:
+            try:
+                results.append(
+                    aggregate_parallel(file, workers, backend, normalizer=normalizer)
+                )
+            except (TooManyParseErrors, OSError) as e:
+                LOGGER.error(f"Лог {file} пропущен: {e!r}")
+                results.append(None)
+        return results
+    with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+        futures = [
+            executor.submit(aggregate_chunk, file, 0, None, backend, normalizer)
+            for file in files
+        ]
+        results = []
+        for file, future in zip(files, futures):
+            try:
+                results.append(future.result())
+            except (TooManyParseErrors, OSError) as e:
+                LOGGER.error(f"Лог {file} пропущен: {e!r}")
+                results.append(None)
+        return results
+
+
+def analyze_range(
+    log_dir, date_from, date_to, workers=1, backend=ExactQuantiles, normalizer=None
+):
+    """Статистика по каждому дню диапазона и общая, слитая из дневных частичных
+    статистик без повторного разбора логов. Дни, логи которых не удалось
+    разобрать, пропускаются"""
+    logs = find_logs(log_dir, date_from, date_to)
+    LOGGER.info(
+        f"Логов за период {date_from or '...'} - {date_to or '...'}: {len(logs)}"
+    )
+    daily = {
+        date: stats
+        for date, stats in zip(
+            logs, aggregate_files(list(logs.values()), workers, backend, normalizer)
+        )
+        if stats is not None
+    }
+    merged = {}
+    for stats in daily.values():
+        for url, url_stats in stats.items():
+            current = merged.get(url)
+            if current is None:
+                current = merged[url] = UrlStats(backend)
+            current.merge(url_stats)
+    return daily, merged
+
+
+def dump_columnar(report, path):
+    """Сохраняет отчет по колонкам в сжатый .npz для архива и повторной отрисовки"""
+    columns = {
+        key: np.array([row[key] for row in report], dtype=COLUMN_TYPES.get(key, float))
+        for key in (report[0] if report else ())
+    }
+    np.savez_compressed(path, **columns)
+    LOGGER.info(f"Архив отчета {path} сохранен")
+
+
+def load_columnar(path):
+    with np.load(path) as data:
+        columns = {key: data[key].tolist() for key in data.files}
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def log_analyzer(
+    file,
+    workers=1,
+    backend=ExactQuantiles,
+    state=None,
+    report_size=None,
+    normalizer=None,
+):
+    try:
+        if state is None:
+            stats = aggregate_parallel(file, workers, backend, normalizer=normalizer)
+        else:
+            stats = aggregate_incremental(file, state, workers, backend, normalizer)
         LOGGER.info("Файл считан. Запускаю анализ")
-        table_json = sorted(table_json, key=grouper)
-        for key, group_items in groupby(table_json, key=grouper):
-            grouped_items = [item for item in group_items]
-            request_time = [item["time_sum"] for item in grouped_items]
-            count = len(grouped_items)
-            time_sum = round(sum(request_time), 3)
-            line_data = {
-                "url": key,
-                "count": count,
-                "count_perc": get_count_perc(count, total_requests_num),
-                "time_sum": time_sum,
-                "time_perc": get_time_perc(time_sum, total_requests_time),
-                "time_avg": round(time_sum / count, 3),
-                "time_max": max(request_time),
-                "time_med": get_mediana(request_time),
-            }
-            report.append(line_data)
-        with open("table_json.json", "w") as f:
-            json.dump(report, f, indent=4)
-            LOGGER.info("Файл table_json.json сформирован")
+        return build_report(stats, report_size)
     except TypeError:
         LOGGER.error("Файл с логами не передан")
         LOGGER.error("Прерываю")
+        return None
+    except TooManyParseErrors:
+        LOGGER.error("Прерываю")
+        return None
 
 
 def get_mediana(request_time):
     LOGGER.debug("Считаем медиану")
+    return get_quantile(request_time, 0.5)
+
+
+def get_quantile(request_time, q):
+    """Точный квантиль с линейной интерполяцией, через np.partition без полной сортировки"""
     try:
-        index = int(len(request_time) / 2)
-        if len(request_time) % 2 == 0:
-            return round((request_time[index - 1] + request_time[index]) / 2, 3)
-        else:
-            return request_time[index]
-    except TypeError:
+        values = np.asarray(request_time, dtype=float)
+        position = (len(values) - 1) * q
+        low = int(position)
+        high = min(low + 1, len(values) - 1)
+        values = np.partition(values, (low, high))
+        return round(
+            float(values[low] + (values[high] - values[low]) * (position - low)), 3
+        )
+    except (TypeError, ValueError):
         LOGGER.error("Передан недопустимый тип данных")
         return None
 
@@ -162,34 +891,280 @@ def get_time_perc(time_sum, total_requests_time):
         return None
 
 
-def render_report(date):
+def load_template(template="report.html"):
+    """Шаблон, разрезанный по $table_json на начало и конец. Перечитывается,
+    только если сменился путь (с учетом текущего каталога) или mtime файла"""
+    path = os.path.abspath(template)
+    return split_template(path, os.stat(path).st_mtime_ns)
+
+
+@lru_cache(maxsize=4)
+def split_template(template, mtime_ns=None):
+    with open(template, "r", encoding="UTF-8") as f:
+        head, placeholder, tail = f.read().partition(TEMPLATE_PLACEHOLDER)
+    if not placeholder:
+        raise ValueError(f"В шаблоне {template} нет {TEMPLATE_PLACEHOLDER}")
+    return head, tail
+
+
+def script_json(value):
+    """JSON, безопасный внутри <script>: url из лога не закроют тег и не
+    начнут новую разметку"""
+    return (
+        json.dumps(value, ensure_ascii=False)
+        .replace("<", "\\u003c")
+        .replace(">", "\\u003e")
+        .replace("&", "\\u0026")
+    )
+
+
+def write_table_json(output, table_json):
+    """Пишет строки отчета JSON-массивом порциями по RENDER_CHUNK_ROWS"""
+    output.write("[")
+    for start in range(0, len(table_json), RENDER_CHUNK_ROWS):
+        if start:
+            output.write(",")
+        chunk = table_json[start : start + RENDER_CHUNK_ROWS]
+        output.write(",".join(script_json(row) for row in chunk))
+    output.write("]")
+
+
+def render_report(date, table_json, template="report.html"):
     LOGGER.info("Начинаю сборку отчета")
     try:
-        with open("report.html", "r") as f:
-            data = f.read()
-            template = Template(data)
-            with open("table_json.json", "r") as json_f:
-                table_json = json.load(json_f)
-        report_name = "report-" + date + ".html"
-    except IOError:
-        LOGGER.error("Во время работы с файлом table_json.json возникла ошибка")
-        LOGGER.error(IOError)
+        head, tail = load_template(template)
+    except (IOError, ValueError) as e:
+        LOGGER.error(f"Во время работы с шаблоном {template} возникла ошибка: {e}")
         return None
+    report_name = report_path(date)
     try:
-        with open(report_name, "w+", encoding="UTF-8", errors="replace") as html_output:
-            html_output.write(template.safe_substitute(table_json=table_json))
-            # html_output.truncate()
-            LOGGER.info(f"Отчет {report_name} готов")
-    except IOError:
-        LOGGER.error(f"Во время записи отчета {report_name} возникла ошибка")
-        LOGGER.error(IOError)
+        with atomic_open(
+            report_name, "w", encoding="UTF-8", errors="replace"
+        ) as html_output:
+            html_output.write(head)
+            write_table_json(html_output, table_json)
+            html_output.write(tail)
+        LOGGER.info(f"Отчет {report_name} готов")
+    except IOError as e:
+        LOGGER.error(f"Во время записи отчета {report_name} возникла ошибка: {e}")
         return None
 
 
+class RollingStats:
+    """Скользящие окна статистики по url (по умолчанию 1, 5 и 15 минут).
+    Хранит не больше max(windows) минутных корзин с UrlStats на t-digest,
+    так что память не зависит от длительности работы"""
+
+    def __init__(self, windows=(1, 5, 15), bucket_seconds=60, backend=TDigest):
+        self.windows = windows
+        self.bucket_seconds = bucket_seconds
+        self.backend = backend
+        self.buckets = deque(maxlen=max(windows))
+
+    def add(self, url, request_time, now):
+        bucket_id = int(now // self.bucket_seconds)
+        if not self.buckets or self.buckets[-1][0] != bucket_id:
+            self.buckets.append((bucket_id, {}))
+        stats = self.buckets[-1][1]
+        url_stats = stats.get(url)
+        if url_stats is None:
+            url_stats = stats[url] = UrlStats(self.backend)
+        url_stats.add(request_time)
+
+    def window_stats(self, window, now):
+        first_bucket = int(now // self.bucket_seconds) - window + 1
+        merged = {}
+        for bucket_id, stats in self.buckets:
+            if bucket_id < first_bucket:
+                continue
+            for url, url_stats in stats.items():
+                current = merged.get(url)
+                if current is None:
+                    current = merged[url] = UrlStats(self.backend)
+                current.merge(url_stats)
+        return merged
+
+    def snapshot(self, now, report_size=None):
+        return {
+            f"{window}m": build_report(self.window_stats(window, now), report_size)
+            for window in self.windows
+        }
+
+
+class LogTailer:
+    """Отдает новые целые строки самого свежего лога в каталоге. После ротации
+    (появился лог за новую дату, файл подменили или обрезали) дочитывает
+    старый файл и переходит на новый с начала"""
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.path = None
+        self.file = None
+        self.tail = b""
+
+    def open(self, path, from_end):
+        if self.file is not None:
+            self.file.close()
+        self.path = path
+        self.file = open(path, "rb")
+        self.tail = b""
+        if from_end:
+            self.file.seek(0, os.SEEK_END)
+        LOGGER.info(f"Слежу за логом {path}")
+
+    def read(self):
+        data = self.tail + self.file.read()
+        lines = data.split(b"\n")
+        self.tail = lines.pop()
+        return lines
+
+    def read_lines(self):
+        latest = find_latest_log(self.log_dir, os.stat(self.log_dir).st_mtime_ns)
+        if latest is None or str(latest[0]).endswith(".gz"):
+            return self.read() if self.file is not None else []
+        if self.file is None:
+            self.open(latest[0], from_end=True)
+            return []
+        lines = self.read()
+        try:
+            file_stat = os.stat(self.path)
+            rotated = file_stat.st_ino != os.fstat(self.file.fileno()).st_ino
+            truncated = file_stat.st_size < self.file.tell()
+        except FileNotFoundError:
+            rotated, truncated = True, False
+        if latest[0] != self.path or rotated:
+            if self.tail:
+                lines.append(self.tail)
+            self.open(latest[0], from_end=False)
+            lines.extend(self.read())
+        elif truncated:
+            self.file.seek(0)
+            self.tail = b""
+        return lines
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def follow_log(
+    log_dir,
+    snapshot_file,
+    interval=10,
+    poll_interval=1.0,
+    report_size=None,
+    iterations=None,
+    normalizer=None,
+):
+    """Хвостит лог и раз в interval секунд атомарно пишет снимок скользящих окон в JSON"""
+    tailer = LogTailer(log_dir)
+    rolling = RollingStats()
+    parse = UiShortParser().parse
+    normalize = normalizer.normalize if normalizer is not None else None
+    errors = 0
+    next_snapshot = time.monotonic() + interval
+    try:
+        while iterations is None or iterations > 0:
+            now = time.time()
+            for line in tailer.read_lines():
+                try:
+                    url, request_time = parse(line)
+                except ValueError:
+                    errors += 1
+                    continue
+                if normalize is not None:
+                    url = normalize(url)
+                rolling.add(url, request_time, now)
+            if time.monotonic() >= next_snapshot:
+                next_snapshot += interval
+                snapshot = {
+                    "timestamp": now,
+                    "file": str(tailer.path),
+                    "errors": errors,
+                    "windows": rolling.snapshot(now, report_size),
+                }
+                with atomic_open(snapshot_file, "w", encoding="UTF-8") as f:
+                    json.dump(snapshot, f, ensure_ascii=False)
+                LOGGER.debug(f"Снимок статистики записан в {snapshot_file}")
+            if iterations is not None:
+                iterations -= 1
+            time.sleep(poll_interval)
+    finally:
+        tailer.close()
+
+
 def main():
+    result_config = get_config()
+    normalizer = get_normalizer(result_config)
+    if args.archive:
+        date = Path(args.archive).stem.split("-", 1)[-1]
+        render_report(date, load_columnar(args.archive))
+        return None
+    if args.follow:
+        return follow_log(
+            result_config["LOG_DIR"],
+            result_config["SNAPSHOT_FILE"],
+            result_config["SNAPSHOT_INTERVAL"],
+            report_size=result_config["REPORT_SIZE"],
+            normalizer=normalizer,
+        )
+    backend = QUANTILE_BACKENDS[result_config["QUANTILE_BACKEND"]]
+    if args.date_from or args.date_to:
+        return main_range(result_config, backend, normalizer)
     file, date = get_log_file()
-    log_analyzer(file)
-    render_report(date)
+    if file is None:
+        return None
+    state_file = result_config["STATE_FILE"]
+    state = load_state(state_file) if state_file else None
+    if (
+        state is not None
+        and is_processed(state, file, backend, normalizer)
+        and os.path.exists(report_path(date))
+    ):
+        LOGGER.info(f"Лог {file} уже разобран, отчет {report_path(date)} построен")
+        return None
+    report = log_analyzer(
+        file, args.workers, backend, state, result_config["REPORT_SIZE"], normalizer
+    )
+    if report is None:
+        return None
+    if state is not None:
+        save_state(state_file, state)
+    publish_report(date, report, result_config["ARCHIVE_DIR"])
+
+
+def main_range(result_config, backend, normalizer=None):
+    try:
+        daily, merged = analyze_range(
+            result_config["LOG_DIR"],
+            args.date_from,
+            args.date_to,
+            args.workers,
+            backend,
+            normalizer,
+        )
+    except FileNotFoundError:
+        LOGGER.error(f"Каталог с логами {result_config['LOG_DIR']} не найден")
+        return None
+    if not daily:
+        LOGGER.error("За указанный период разобранных логов нет")
+        return None
+    report_size = result_config["REPORT_SIZE"]
+    for date, stats in daily.items():
+        publish_report(
+            date, build_report(stats, report_size), result_config["ARCHIVE_DIR"]
+        )
+    period = f"{min(daily)}-{max(daily)}"
+    publish_report(
+        period, build_report(merged, report_size), result_config["ARCHIVE_DIR"]
+    )
+
+
+def publish_report(date, report, archive_dir=None):
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        dump_columnar(report, os.path.join(archive_dir, f"report-{date}.npz"))
+    render_report(date, report)
 
 
 if __name__ == "__main__":
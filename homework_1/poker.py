@@ -27,6 +27,30 @@
 # Можно свободно определять свои функции и т.п.
 # -----------------
 
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import (
+    chain,
+    combinations,
+    combinations_with_replacement,
+    count as count_from,
+    islice,
+    permutations,
+)
+from math import comb, sqrt
+import hashlib
+import os
+import re
+import tempfile
+
+import numpy as np
+
+RANKS = "23456789TJQKA"
+SUITS = "CSHD"
+PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+RANK_INDEX = {rank: index for index, rank in enumerate(RANKS)}
+
 
 def hand_rank(hand):
     """Возвращает значение определяющее ранг 'руки'"""
@@ -54,40 +78,818 @@ def hand_rank(hand):
 def card_ranks(hand):
     """Возвращает список рангов (его числовой эквивалент),
     отсортированный от большего к меньшему"""
-    return
+    ranks = sorted(("--" + RANKS).index(rank) for rank, suit in hand)[::-1]
+    return [5, 4, 3, 2, 1] if ranks == [14, 5, 4, 3, 2] else ranks
 
 
 def flush(hand):
     """Возвращает True, если все карты одной масти"""
-    return
+    return len({suit for rank, suit in hand}) == 1
 
 
 def straight(ranks):
     """Возвращает True, если отсортированные ранги формируют последовательность 5ти,
     где у 5ти карт ранги идут по порядку (стрит)"""
-    return
+    return len(set(ranks)) == 5 and ranks[0] - ranks[-1] == 4
 
 
 def kind(n, ranks):
     """Возвращает первый ранг, который n раз встречается в данной руке.
     Возвращает None, если ничего не найдено"""
-    return
+    for rank in ranks:
+        if ranks.count(rank) == n:
+            return rank
+    return None
 
 
 def two_pair(ranks):
     """Если есть две пары, то возврщает два соответствующих ранга,
     иначе возвращает None"""
-    return
+    high = kind(2, ranks)
+    low = kind(2, ranks[::-1])
+    if high and low != high:
+        return high, low
+    return None
+
+
+# -----------------
+# Быстрая оценка руки из 5ти карт по таблицам (схема Cactus Kev).
+# Карта кодируется 32-битным целым:
+#   биты 16-28 - маска ранга, 12-15 - маска масти, 8-11 - ранг, 0-7 - простое число ранга.
+# Для флешей и рук из 5ти разных рангов ранг руки берется из таблиц по маске рангов,
+# для остальных - из словаря по произведению простых чисел рангов.
+# Значение - целое число, порядок которого совпадает с порядком кортежей hand_rank:
+# HAND_RANKS[fast_hand_rank(hand)] == hand_rank(hand) в "замороженном" виде.
+# -----------------
+
+
+def encode_card(card):
+    """Кодирует карту вида 'AS' в целое число"""
+    rank = RANKS.index(card[0])
+    suit = SUITS.index(card[1])
+    return (1 << (16 + rank)) | (1 << (12 + suit)) | (rank << 8) | PRIMES[rank]
+
+
+def decode_card(code):
+    return RANKS[(code >> 8) & 0xF] + SUITS[((code >> 12) & 0xF).bit_length() - 1]
+
+
+def freeze(rank):
+    """Кортеж hand_rank с вложенными списками, превращенными в кортежи"""
+    return tuple(tuple(item) if isinstance(item, list) else item for item in rank)
+
+
+def build_tables():
+    """Перебирает все 7462 класса рук и нумерует их с 1 в порядке hand_rank
+    (0 в таблицах означает отсутствие записи)"""
+    hands = []
+    for ranks in combinations_with_replacement(RANKS[::-1], 5):
+        if any(ranks.count(rank) > 4 for rank in ranks):
+            continue
+        hands.append([rank + SUITS[i % 4] for i, rank in enumerate(ranks)])
+        if len(set(ranks)) == 5:
+            hands.append([rank + SUITS[0] for rank in ranks])
+    classes = {freeze(hand_rank(hand)): hand for hand in hands}
+    hand_ranks = [None] + sorted(classes)
+    flushes = [0] * 8192
+    unique5 = [0] * 8192
+    products = {}
+    for value, rank in enumerate(hand_ranks[1:], 1):
+        codes = [encode_card(card) for card in classes[rank]]
+        bits = (codes[0] | codes[1] | codes[2] | codes[3] | codes[4]) >> 16
+        if flush(classes[rank]):
+            flushes[bits] = value
+        elif len(set(card[0] for card in classes[rank])) == 5:
+            unique5[bits] = value
+        else:
+            product = 1
+            for code in codes:
+                product *= code & 0xFF
+            products[product] = value
+    return hand_ranks, flushes, unique5, products
+
+
+def fast_hand_rank(hand):
+    """Ранг руки из 5ти карт за O(1): целое число, сравнимое так же, как hand_rank.
+    Принимает строки вида 'AS' или карты, закодированные encode_card"""
+    c1, c2, c3, c4, c5 = (
+        ENCODED[card] if isinstance(card, str) else card for card in hand
+    )
+    if c1 & c2 & c3 & c4 & c5 & 0xF000:
+        return FLUSHES[(c1 | c2 | c3 | c4 | c5) >> 16]
+    value = UNIQUE5[(c1 | c2 | c3 | c4 | c5) >> 16]
+    if value:
+        return value
+    return PRODUCTS[(c1 & 0xFF) * (c2 & 0xFF) * (c3 & 0xFF) * (c4 & 0xFF) * (c5 & 0xFF)]
 
 
 def best_hand(hand):
-    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт"""
-    return
+    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт.
+    Вместо перебора 21 сочетания через hand_rank за один проход строит
+    гистограмму рангов и раскладку по мастям и собирает лучшую комбинацию,
+    проверяя категории от старшей к младшей"""
+    by_rank = [[] for _ in RANKS]
+    by_suit = {suit: [] for suit in SUITS}
+    for card in hand:
+        by_rank[RANK_INDEX[card[0]]].append(card)
+        by_suit[card[1]].append(card)
+    flush_cards = next((cards for cards in by_suit.values() if len(cards) >= 5), None)
+    if flush_cards:
+        flush_by_rank = [[] for _ in RANKS]
+        for card in flush_cards:
+            flush_by_rank[RANK_INDEX[card[0]]].append(card)
+        straight_flush = find_straight(flush_by_rank)
+        if straight_flush:
+            return straight_flush
+    groups = sorted(
+        ((len(cards), rank) for rank, cards in enumerate(by_rank) if cards),
+        reverse=True,
+    )
+    count, rank = groups[0]
+    if count == 4:
+        return by_rank[rank] + kickers(by_rank, 1, rank)
+    if count == 3 and len(groups) > 1 and groups[1][0] >= 2:
+        return by_rank[rank] + by_rank[groups[1][1]][:2]
+    if flush_cards:
+        return sorted(flush_cards, key=lambda card: RANK_INDEX[card[0]])[-5:]
+    straight_cards = find_straight(by_rank)
+    if straight_cards:
+        return straight_cards
+    if count == 3:
+        return by_rank[rank] + kickers(by_rank, 2, rank)
+    if count == 2 and groups[1][0] == 2:
+        second = groups[1][1]
+        return by_rank[rank] + by_rank[second] + kickers(by_rank, 1, rank, second)
+    if count == 2:
+        return by_rank[rank] + kickers(by_rank, 3, rank)
+    return kickers(by_rank, 5)
+
+
+def find_straight(by_rank):
+    """Старший стрит из раскладки карт по рангам (по одной карте на ранг) или None"""
+    for high in range(len(RANKS) - 1, 2, -1):
+        ranks = straight_ranks(high)
+        if all(by_rank[rank] for rank in ranks):
+            return [by_rank[rank][0] for rank in ranks]
+    return None
+
+
+def kickers(by_rank, n, *exclude):
+    """n старших карт, не входящих в ранги exclude"""
+    cards = [
+        card
+        for rank in range(len(RANKS) - 1, -1, -1)
+        if rank not in exclude
+        for card in by_rank[rank]
+    ]
+    return cards[:n]
+
+
+JOKERS = {"?B": "CS", "?R": "HD"}
 
 
 def best_wild_hand(hand):
-    """best_hand но с джокерами"""
-    return
+    """best_hand но с джокерами.
+    Джокеры не перебираются по всем картам своего цвета: категории проверяются
+    от старшей к младшей, в каждой ищется старший "каркас" (ранги комбинации),
+    который можно собрать из своих карт и джокеров, а кикеры добираются жадно.
+    Первая собранная категория и есть ответ, младшие не рассматриваются"""
+    jokers = [JOKERS[card] for card in hand if card in JOKERS]
+    if not jokers:
+        return best_hand(hand)
+    cards = [card for card in hand if card not in JOKERS]
+    by_rank = [[] for _ in RANKS]
+    for card in cards:
+        by_rank[RANK_INDEX[card[0]]].append(card)
+    wild = (by_rank, set(cards), jokers)
+    top = range(len(RANKS) - 1, -1, -1)
+
+    for high in range(len(RANKS) - 1, 2, -1):
+        for suit in SUITS:
+            found = wild_complete(
+                wild, [(rank, suit, 1) for rank in straight_ranks(high)]
+            )
+            if found:
+                return found[0]
+    for rank in top:
+        found = wild_complete(wild, [(rank, SUITS, 4)])
+        if found:
+            return wild_kickers(wild, 1, *found)
+    for three in top:
+        for two in top:
+            if two != three:
+                found = wild_complete(wild, [(three, SUITS, 3), (two, SUITS, 2)])
+                if found:
+                    return found[0]
+    flush_cards = wild_flush(wild)
+    if flush_cards:
+        return flush_cards
+    for high in range(len(RANKS) - 1, 2, -1):
+        found = wild_complete(wild, [(rank, SUITS, 1) for rank in straight_ranks(high)])
+        if found:
+            return found[0]
+    for rank in top:
+        found = wild_complete(wild, [(rank, SUITS, 3)])
+        if found:
+            return wild_kickers(wild, 2, *found)
+    for high in top:
+        for low in range(high - 1, -1, -1):
+            found = wild_complete(wild, [(high, SUITS, 2), (low, SUITS, 2)])
+            if found:
+                return wild_kickers(wild, 1, *found)
+    for rank in top:
+        found = wild_complete(wild, [(rank, SUITS, 2)])
+        if found:
+            return wild_kickers(wild, 3, *found)
+    return wild_kickers(wild, 5, [], jokers)
+
+
+def straight_ranks(high):
+    """Ранги стрита со старшей картой high (для high == 3 - стрит от туза до пятерки)"""
+    return [high - i for i in range(5)] if high > 3 else [3, 2, 1, 0, 12]
+
+
+def wild_complete(wild, slots):
+    """Собирает каркас комбинации: slots - список (ранг, допустимые масти, число карт).
+    Сначала берутся свои карты, недостающие закрываются джокерами.
+    Возвращает (карты, неиспользованные джокеры) или None"""
+    by_rank, used, jokers = wild
+    cards = []
+    missing = []
+    for rank, suits, count in slots:
+        own = [card for card in by_rank[rank] if card[1] in suits][:count]
+        if len(missing) + count - len(own) > len(jokers):
+            return None
+        cards += own
+        missing += [(rank, suits)] * (count - len(own))
+    if not missing:
+        return cards, jokers
+    found = wild_fill(missing, jokers, used)
+    if found is None:
+        return None
+    return cards + found[0], found[1]
+
+
+def wild_fill(missing, jokers, used):
+    """Подбирает джокерам карты для недостающих мест каркаса (мест не больше, чем джокеров)"""
+    if not missing:
+        return [], jokers
+    rank, suits = missing[0]
+    for i, colors in enumerate(jokers):
+        for suit in colors:
+            card = RANKS[rank] + suit
+            if suit in suits and card not in used:
+                found = wild_fill(
+                    missing[1:], jokers[:i] + jokers[i + 1 :], used | {card}
+                )
+                if found is not None:
+                    return [card] + found[0], found[1]
+    return None
+
+
+def wild_kickers(wild, n, cards, jokers):
+    """Дополняет cards n старшими картами разных рангов, не совпадающих с рангами cards.
+    Ранг, которого нет на руке, закрывается оставшимся джокером"""
+    by_rank, used, _ = wild
+    exclude = {RANK_INDEX[card[0]] for card in cards}
+    used = used | set(cards)
+    result = list(cards)
+    for rank in range(len(RANKS) - 1, -1, -1):
+        if len(result) == len(cards) + n:
+            break
+        if rank in exclude:
+            continue
+        if by_rank[rank]:
+            result.append(by_rank[rank][0])
+            continue
+        for i, colors in enumerate(jokers):
+            card = next(
+                (
+                    RANKS[rank] + suit
+                    for suit in colors
+                    if RANKS[rank] + suit not in used
+                ),
+                None,
+            )
+            if card:
+                result.append(card)
+                jokers = jokers[:i] + jokers[i + 1 :]
+                break
+    return result
+
+
+def wild_flush(wild):
+    """Старший флеш: в каждой масти свои карты дополняются джокерами этой масти
+    до старших свободных рангов. Возвращает 5 карт или None"""
+    by_rank, used, jokers = wild
+    best = None
+    for suit in SUITS:
+        ranks = [rank for rank in range(len(RANKS)) if RANKS[rank] + suit in used]
+        free = [rank for rank in range(len(RANKS) - 1, -1, -1) if rank not in ranks]
+        wilds = sum(suit in colors for colors in jokers)
+        ranks = sorted(ranks + free[:wilds], reverse=True)[:5]
+        if len(ranks) == 5 and (best is None or ranks > best[0]):
+            best = ranks, suit
+    if best is None:
+        return None
+    ranks, suit = best
+    return [RANKS[rank] + suit for rank in ranks]
+
+
+def encode_hands(hands):
+    """Массив (N, k) кодов encode_card для списка рук из карт вида 'AS'"""
+    return np.array(
+        [[ENCODED[card] for card in hand] for hand in hands], dtype=np.int64
+    )
+
+
+def rank_hands(hands, check=True):
+    """Ранги лучших рук для массива (N, 7) карт, закодированных encode_card.
+    Возвращает массив из N целых чисел в шкале fast_hand_rank
+    (HAND_RANKS[rank_hands(hands)[i]] == hand_rank(best_hand(hands[i]))).
+    Вместо вызова best_hand на каждую руку по всему массиву сразу считается
+    гистограмма мастей и произведение простых чисел рангов, а ранг руки берется
+    из таблиц для 7ми карт. Неверная форма, коды карт или повторы карт в руке -
+    ValueError; check=False пропускает проверку кодов и повторов для заведомо
+    верных раздач"""
+    hands = np.asarray(hands, dtype=np.int64)
+    if hands.ndim != 2 or hands.shape[1] != 7:
+        raise ValueError(f"Нужен массив (N, 7) карт, получен {hands.shape}")
+    if check:
+        if not np.isin(hands, CARD_CODES).all():
+            raise ValueError("Неверные коды карт")
+        if (np.diff(np.sort(hands, axis=1), axis=1) == 0).any():
+            raise ValueError("Карты в руке повторяются")
+    flushes7, products7, values7 = batch_tables()
+    rank_bits = (hands >> 16) & 0x1FFF
+    suit_bits = (hands >> 12) & 0xF
+    flush_bits = np.zeros(len(hands), dtype=np.int64)
+    for suit in (1, 2, 4, 8):
+        in_suit = suit_bits == suit
+        flush = in_suit.sum(axis=1) >= 5
+        if flush.any():
+            bits = np.bitwise_or.reduce(
+                np.where(in_suit[flush], rank_bits[flush], 0), axis=1
+            )
+            flush_bits[flush] = bits
+    products = np.prod(hands & 0xFF, axis=1)
+    index = np.minimum(np.searchsorted(products7, products), len(products7) - 1)
+    if (products7[index] != products).any():
+        raise ValueError("Неверные ранги карт")
+    values = values7[index]
+    return np.maximum(values, flushes7[flush_bits])
+
+
+# Таблицы rank_hands кэшируются в файле в личном каталоге кэша пользователя.
+# В имени файла - префикс sha256 содержимого, при загрузке хеш проверяется целиком,
+# так что устаревший или подложенный файл не используется, а пересобирается.
+RANK_TABLE_SIZE = 8192 + 2 * 49205
+RANK_TABLE_SHA256 = "cba5248ec87898799e174af3428a27e8f896ec2ae965c3a1b04940e2d5625394"
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "poker",
+)
+RANK_TABLE_FILE = os.path.join(CACHE_DIR, f"rank_tables-{RANK_TABLE_SHA256[:16]}.npy")
+# Счетчики matchup_counts - по файлу на канонический ключ матча, в каталоге,
+# привязанном к версии таблиц рангов
+MATCHUP_DIR = os.path.join(CACHE_DIR, f"matchups-{RANK_TABLE_SHA256[:16]}")
+
+
+@lru_cache(maxsize=None)
+def batch_tables():
+    """Таблицы для rank_hands. Хранятся одним массивом в RANK_TABLE_FILE
+    и открываются через mmap: строит их только первый запуск, а остальные
+    запуски и процессы делят страницы файла"""
+    try:
+        table = np.load(RANK_TABLE_FILE, mmap_mode="r")
+    except (OSError, ValueError):
+        table = None
+    if table is None or not valid_table(table):
+        table = np.concatenate(build_batch_tables())
+        if valid_table(table):
+            try:
+                save_table(RANK_TABLE_FILE, table)
+            except OSError:
+                pass
+    multisets = (RANK_TABLE_SIZE - 8192) // 2
+    return table[:8192], table[8192 : 8192 + multisets], table[8192 + multisets :]
+
+
+def valid_table(table):
+    """Таблица нужного размера и типа с ожидаемым хешем содержимого"""
+    return (
+        table.shape == (RANK_TABLE_SIZE,)
+        and table.dtype == np.dtype("<i8")
+        and hashlib.sha256(table.tobytes()).hexdigest() == RANK_TABLE_SHA256
+    )
+
+
+def save_table(path, table):
+    """Пишет таблицу во временный файл рядом с path и подменяет path целиком"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=f".{os.path.basename(path)}-"
+    )
+    try:
+        with open(fd, "wb") as f:
+            np.save(f, table)
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def build_batch_tables():
+    """Лучший флеш по маске рангов одной масти (5-7 карт) и лучшая рука без флеша
+    по произведению простых чисел рангов 7ми карт (ключи отсортированы для searchsorted).
+    Масти в ключах не участвуют, так что изоморфные по мастям руки делят одну запись
+    """
+    flushes = np.array(FLUSHES, dtype=np.int64)
+    unique5 = np.array(UNIQUE5, dtype=np.int64)
+    products5 = np.array(sorted(PRODUCTS), dtype=np.int64)
+    values5 = np.array([PRODUCTS[key] for key in products5], dtype=np.int64)
+    primes = np.array(PRIMES, dtype=np.int64)
+
+    def rank_flush(ranks):
+        return flushes[np.bitwise_or.reduce(1 << ranks, axis=1)]
+
+    def rank_other(ranks):
+        value = unique5[np.bitwise_or.reduce(1 << ranks, axis=1)]
+        index = np.searchsorted(products5, np.prod(primes[ranks], axis=1))
+        index = np.minimum(index, len(products5) - 1)
+        return np.where(value > 0, value, values5[index])
+
+    flushes7 = np.zeros(8192, dtype=np.int64)
+    for size in (5, 6, 7):
+        ranks = np.array(list(combinations(range(len(RANKS)), size)), dtype=np.int64)
+        masks = np.bitwise_or.reduce(1 << ranks, axis=1)
+        flushes7[masks] = best_of_five(ranks, rank_flush)
+
+    ranks = np.array(
+        list(combinations_with_replacement(range(len(RANKS)), 7)), dtype=np.int64
+    )
+    ranks = ranks[(ranks[:, :3] != ranks[:, 4:]).all(axis=1)]
+    products7 = np.prod(primes[ranks], axis=1)
+    order = np.argsort(products7)
+    return flushes7, products7[order], best_of_five(ranks, rank_other)[order]
+
+
+def best_of_five(ranks, rank5):
+    """Максимум rank5 по всем сочетаниям 5ти столбцов массива рангов (M, k)"""
+    best = np.zeros(len(ranks), dtype=np.int64)
+    for columns in combinations(range(ranks.shape[1]), 5):
+        best = np.maximum(best, rank5(ranks[:, columns]))
+    return best
+
+
+# -----------------
+# Эквити: доли выигрышей, ничьих и проигрышей карт игрока (hole) против opponents
+# случайных рук при частично открытом столе (board). Раздачи считаются пачками
+# через rank_hands. Если вариантов раздачи не больше exact_limit, они перебираются
+# все, иначе разыгрываются случайно с seed, пачки можно раздать пулу процессов.
+# -----------------
+
+Equity = namedtuple("Equity", "win tie loss equity trials margin")
+
+
+def equity(hole, board=(), opponents=1, trials=100000, margin=None, **kwargs):
+    """Итоговая оценка эквити. Если задан margin, счет останавливается, как только
+    полуширина 95% доверительного интервала эквити станет не больше margin"""
+    for estimate in iter_equity(hole, board, opponents, trials, **kwargs):
+        if margin is not None and estimate.margin <= margin:
+            break
+    return estimate
+
+
+def iter_equity(
+    hole,
+    board=(),
+    opponents=1,
+    trials=100000,
+    batch=10000,
+    seed=0,
+    workers=1,
+    exact_limit=200000,
+):
+    """Выдает уточняющиеся оценки Equity после каждой пачки раздач.
+    Пачка i разыгрывается генератором с зерном (seed, i), поэтому последовательность
+    оценок не зависит от числа процессов. trials=None - играть, пока вызывающий
+    не прекратит итерацию. Если вариантов раздачи не больше exact_limit,
+    выдается одна точная оценка с margin == 0"""
+    hole, board = list(hole), list(board)
+    rest = [card for card in ENCODED if card not in hole + board]
+    if len(hole) != 2 or len(board) > 5 or len(rest) + len(hole + board) != 52:
+        raise ValueError(f"Неверные карты: {hole} {board}")
+    sizes = [5 - len(board)] + [2] * opponents
+    if sum(sizes) > len(rest):
+        raise ValueError(f"Не хватает карт для {opponents} соперников")
+    if trials is not None and trials <= 0:
+        raise ValueError(f"Число раздач должно быть положительным: {trials}")
+    total = 1
+    left = len(rest)
+    for size in sizes:
+        total *= comb(left, size)
+        left -= size
+    if total <= exact_limit:
+        yield equity_exact(hole, board, rest, sizes, batch)
+        return
+    starts = count_from(0, batch) if trials is None else range(0, trials, batch)
+    jobs = (
+        (
+            hole,
+            board,
+            opponents,
+            batch if trials is None else min(batch, trials - start),
+            (seed, i),
+        )
+        for i, start in enumerate(starts)
+    )
+    counts = np.zeros(5)
+    for result in map_jobs(equity_batch, jobs, workers):
+        counts += result
+        yield make_equity(counts)
+
+
+def map_jobs(function, jobs, workers):
+    """Лениво выполняет function(*job) по порядку jobs. При workers > 1 - в пуле
+    процессов, держа в работе не больше 2 * workers пачек"""
+    if workers <= 1:
+        for job in jobs:
+            yield function(*job)
+        return
+    executor = ProcessPoolExecutor(max_workers=workers)
+    futures = deque()
+    try:
+        for job in islice(jobs, 2 * workers):
+            futures.append(executor.submit(function, *job))
+        while futures:
+            result = futures.popleft().result()
+            for job in islice(jobs, 1):
+                futures.append(executor.submit(function, *job))
+            yield result
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def equity_batch(hole, board, opponents, size, seed):
+    """Разыгрывает size случайных раздач, возвращает счетчики для make_equity"""
+    rest = np.array(
+        [code for card, code in ENCODED.items() if card not in hole + board]
+    )
+    need = 5 - len(board) + 2 * opponents
+    rng = np.random.default_rng(seed)
+    deals = rest[rng.random((size, len(rest))).argsort(axis=1)[:, :need]]
+    return score_deals(hole, board, opponents, deals)
+
+
+def equity_exact(hole, board, rest, sizes, batch):
+    """Перебирает все раздачи оставшихся карт и возвращает точную Equity"""
+    deals = ([ENCODED[card] for card in deal] for deal in iter_deals(rest, sizes))
+    counts = np.zeros(5)
+    while True:
+        chunk = list(islice(deals, batch))
+        if not chunk:
+            break
+        counts += score_deals(
+            hole, board, len(sizes) - 1, np.array(chunk, dtype=np.int64)
+        )
+    return make_equity(counts)._replace(margin=0.0)
+
+
+def iter_deals(cards, sizes):
+    """Все раздачи карт cards на группы размеров sizes (первая - досдача стола)"""
+    if not sizes:
+        yield ()
+        return
+    for group in combinations(cards, sizes[0]):
+        left = [card for card in cards if card not in group]
+        for deal in iter_deals(left, sizes[1:]):
+            yield group + deal
+
+
+def score_deals(hole, board, opponents, deals):
+    """deals - массив (N, k) доданных карт: сначала стол, затем по 2 карты соперникам.
+    Возвращает [выигрыши, ничьи, проигрыши, сумма долей банка, сумма квадратов долей]"""
+    size = len(deals)
+    missing = 5 - len(board)
+    table = np.hstack([np.tile(encode_hands([board]), (size, 1)), deals[:, :missing]])
+    hero = rank_hands(
+        np.hstack([np.tile(encode_hands([hole]), (size, 1)), table]), check=False
+    )
+    rivals = np.stack(
+        [
+            rank_hands(
+                np.hstack([deals[:, missing + 2 * i : missing + 2 * i + 2], table]),
+                check=False,
+            )
+            for i in range(opponents)
+        ],
+        axis=1,
+    )
+    best = rivals.max(axis=1)
+    win = hero > best
+    tie = hero == best
+    share = np.where(
+        win, 1.0, np.where(tie, 1.0 / (1 + (rivals == best[:, None]).sum(axis=1)), 0.0)
+    )
+    return np.array(
+        [
+            win.sum(),
+            tie.sum(),
+            size - win.sum() - tie.sum(),
+            share.sum(),
+            (share**2).sum(),
+        ]
+    )
+
+
+def make_equity(counts):
+    """Equity из накопленных счетчиков score_deals"""
+    win, tie, loss, share, square = counts
+    trials = int(win + tie + loss)
+    mean = share / trials
+    variance = max(square / trials - mean**2, 0.0)
+    margin = 1.96 * sqrt(variance / trials)
+    return Equity(
+        float(win / trials),
+        float(tie / trials),
+        float(loss / trials),
+        float(mean),
+        trials,
+        margin,
+    )
+
+
+# -----------------
+# Диапазоны рук вида "QQ+, AKs, A2s-A5s, KQo, AhKh" и точное эквити
+# рука против руки перебором всех досдач стола. Результат матча запоминается
+# по каноническому ключу: минимальной записи рук и стола по всем 24 перестановкам
+# мастей, так что AsAh против KsKh и AdAc против KdKc считаются один раз.
+# Кроме памяти процесса результат сохраняется в MATCHUP_DIR, и следующие запуски
+# и другие процессы берут его оттуда.
+# -----------------
+
+RANGE_TOKEN = re.compile(r"([2-9TJQKA])([2-9TJQKA])([so]?)")
+SUIT_PERMUTATIONS = [dict(zip(SUITS, suits)) for suits in permutations(SUITS)]
+
+
+def parse_range(text):
+    """Список рук (пар карт, старшая первой) диапазона, без повторов"""
+    combos = []
+    for token in text.replace(" ", "").split(","):
+        if token:
+            combos += range_token_combos(token)
+    return list(dict.fromkeys(combos))
+
+
+def range_token_combos(token):
+    if re.fullmatch(r"([2-9TJQKA][cdhsCDHS]){2}", token):
+        cards = sorted((token[:2], token[2:]), key=lambda card: -RANK_INDEX[card[0]])
+        return [tuple(card[0] + card[1].upper() for card in cards)]
+    low, _, high = token.partition("-")
+    plus = low.endswith("+") and not high
+    low_match = RANGE_TOKEN.fullmatch(low.rstrip("+") if plus else low)
+    high_match = RANGE_TOKEN.fullmatch(high) if high else low_match
+    if not low_match or not high_match or high_match.group(3) != low_match.group(3):
+        raise ValueError(f"Неверный диапазон: {token}")
+    first, second, kind = low_match.groups()
+    first, second = sorted((RANK_INDEX[first], RANK_INDEX[second]), reverse=True)
+    top_first, top_second = sorted(
+        (RANK_INDEX[high_match.group(1)], RANK_INDEX[high_match.group(2)]), reverse=True
+    )
+    if first == second:
+        if top_first != top_second or kind:
+            raise ValueError(f"Неверный диапазон: {token}")
+        top = len(RANKS) - 1 if plus else top_first
+        shapes = [(rank, rank) for rank in range(min(first, top), max(first, top) + 1)]
+    else:
+        if top_first != first or top_second == top_first:
+            raise ValueError(f"Неверный диапазон: {token}")
+        top = first - 1 if plus else top_second
+        shapes = [
+            (first, rank) for rank in range(min(second, top), max(second, top) + 1)
+        ]
+    return [combo for shape in reversed(shapes) for combo in shape_combos(*shape, kind)]
+
+
+def shape_combos(first, second, kind):
+    """Все руки формы: пара, одномастные (s), разномастные (o) или любые"""
+    high = [RANKS[first] + suit for suit in SUITS]
+    low = [RANKS[second] + suit for suit in SUITS]
+    if first == second:
+        return list(combinations(high, 2))
+    return [
+        (a, b) for a in high for b in low if not kind or (a[1] == b[1]) == (kind == "s")
+    ]
+
+
+def canonical_matchup(hole, rival, board=()):
+    """Минимальная запись (hole, rival, board) по всем перестановкам мастей"""
+    return min(
+        tuple(
+            tuple(sorted(card[0] + suits[card[1]] for card in group))
+            for group in (hole, rival, board)
+        )
+        for suits in SUIT_PERMUTATIONS
+    )
+
+
+def matchup_equity(hole, rival, board=()):
+    """Точная Equity руки hole против rival перебором всех досдач стола"""
+    return make_equity(matchup_counts(canonical_matchup(hole, rival, board)))._replace(
+        margin=0.0
+    )
+
+
+@lru_cache(maxsize=65536)
+def matchup_counts(key):
+    """Счетчики score_deals по всем досдачам для канонического ключа матча.
+    Берутся из файла в MATCHUP_DIR, если он есть, иначе считаются и сохраняются"""
+    hole, rival, board = key
+    if len(set(hole + rival + board)) != 4 + len(board):
+        raise ValueError(f"Карты пересекаются: {hole} {rival} {board}")
+    path = matchup_path(key)
+    try:
+        counts = np.load(path)
+    except (OSError, ValueError):
+        counts = None
+    if counts is not None and valid_counts(counts):
+        return counts
+    counts = count_matchup(hole, rival, board)
+    try:
+        save_table(path, counts)
+    except OSError:
+        pass
+    return counts
+
+
+def matchup_path(key):
+    digest = hashlib.sha256(repr(key).encode()).hexdigest()
+    return os.path.join(MATCHUP_DIR, f"{digest[:32]}.npy")
+
+
+def valid_counts(counts):
+    return (
+        counts.shape == (5,)
+        and counts.dtype == np.dtype("<f8")
+        and np.isfinite(counts).all()
+        and (counts >= 0).all()
+    )
+
+
+def count_matchup(hole, rival, board):
+    """Счетчики score_deals перебором всех досдач стола"""
+    rest = np.array(
+        [code for card, code in ENCODED.items() if card not in hole + rival + board]
+    )
+    rival_codes = encode_hands([rival])
+    counts = np.zeros(5)
+    runouts = runout_indices(len(rest), 5 - len(board))
+    for start in range(0, len(runouts), 200000):
+        deals = rest[runouts[start : start + 200000]]
+        deals = np.hstack([deals, np.tile(rival_codes, (len(deals), 1))])
+        counts += score_deals(list(hole), list(board), 1, deals)
+    return counts
+
+
+@lru_cache(maxsize=8)
+def runout_indices(n, k):
+    """Массив (C(n, k), k) всех сочетаний индексов 0..n-1.
+    При k == 0 (стол уже полный) - одна пустая досдача"""
+    if k == 0:
+        return np.empty((1, 0), dtype=np.int8)
+    flat = np.fromiter(
+        chain.from_iterable(combinations(range(n), k)),
+        dtype=np.int8,
+        count=comb(n, k) * k,
+    )
+    return flat.reshape(-1, k)
+
+
+def range_equity(hero, villain, board=()):
+    """Эквити каждой руки диапазона hero против диапазона villain.
+    Диапазоны - строки для parse_range или списки рук. Руки villain, пересекающиеся
+    с рукой hero или столом, пропускаются. Возвращает {рука: Equity}"""
+    board = list(board)
+    hero = parse_range(hero) if isinstance(hero, str) else hero
+    villain = parse_range(villain) if isinstance(villain, str) else villain
+    result = {}
+    for hole in hero:
+        if set(hole) & set(board):
+            continue
+        counts = np.zeros(5)
+        for rival in villain:
+            if not set(rival) & set(hole + tuple(board)):
+                counts += matchup_counts(canonical_matchup(hole, rival, board))
+        if counts.any():
+            result[hole] = make_equity(counts)._replace(margin=0.0)
+    return result
+
+
+HAND_RANKS, FLUSHES, UNIQUE5, PRODUCTS = build_tables()
+ENCODED = {rank + suit: encode_card(rank + suit) for rank in RANKS for suit in SUITS}
+CARD_CODES = np.array(sorted(ENCODED.values()), dtype=np.int64)
 
 
 def test_best_hand():
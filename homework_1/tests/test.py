@@ -1,12 +1,64 @@
+import argparse
+import gzip
+import json
+import os
+import threading
+
+import numpy as np
 import pytest
 
 from ..log_analyzer import (
+    ERRORS_MIN_LINES,
+    aggregate,
+    aggregate_incremental,
+    aggregate_parallel,
+    analyze_range,
+    build_report,
+    dump_columnar,
+    find_latest_log,
+    find_logs,
     check_errors_percent,
+    config,
+    get_chunks,
+    get_normalizer,
+    is_processed,
+    gzip_blocks,
+    log_analyzer,
+    log_date,
+    log_finder,
+    parser,
+    log_reader,
+    main,
+    ParseErrors,
+    TooManyParseErrors,
+    LogTailer,
+    load_columnar,
+    load_state,
+    render_report,
+    RollingStats,
+    save_state,
+    TDigest,
+    UiShortParser,
+    UrlNormalizer,
     get_mediana,
     get_count_perc,
     get_time_perc,
 )
 
+LOG_LINE = (
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" '
+    '"Lynx/2.8.8dev.9 libwww-FM/2.14" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {time}\n'
+)
+
+
+@pytest.fixture()
+def log_file(tmp_path):
+    path = tmp_path / "nginx-access-ui.log-20170630"
+    with open(path, "w") as f:
+        for i in range(1000):
+            f.write(LOG_LINE.format(url=f"/api/v2/banner/{i % 7}", time=i / 1000))
+    return path
+
 
 @pytest.mark.parametrize(
     "exeptions_counter, lines, expected",
@@ -25,6 +77,8 @@ def test_check_errors_percent(exeptions_counter, lines, expected):
     [
         ([1, 2, 3, 4, 5], 3),
         ([1, 2, 3, 4], 2.5),
+        ([5, 1, 4, 2, 3], 3),
+        ([0.4, 0.1, 0.3, 0.2], 0.25),
         (["a", "d", 3, 4], None),
     ],
 )
@@ -52,3 +106,477 @@ def test_check_get_count_perc(count, total_requests_num, expected):
 )
 def test_check_get_time_perc(time_sum, total_requests_time, expected):
     assert get_time_perc(time_sum, total_requests_time) == expected
+
+
+def test_aggregate():
+    stats = aggregate([("/a", "0.1"), ("/b", "0.5"), ("/a", "0.3")])
+    assert sorted(stats) == ["/a", "/b"]
+    assert stats["/a"].count == 2
+    assert stats["/a"].time_sum == pytest.approx(0.4)
+    assert stats["/a"].time_max == 0.3
+    assert list(stats["/a"].quantiles.times) == [0.1, 0.3]
+
+
+def test_build_report():
+    report = build_report(aggregate([("/a", "1"), ("/b", "2"), ("/a", "1")]))
+    row = next(line for line in report if line["url"] == "/a")
+    assert row["count"] == 2
+    assert row["count_perc"] == 66.667
+    assert row["time_sum"] == 2
+    assert row["time_perc"] == 50
+    assert row["time_avg"] == 1
+    assert row["time_max"] == 1
+
+
+@pytest.mark.parametrize("workers", [1, 2, 3, 16])
+def test_get_chunks(log_file, workers):
+    chunks = get_chunks(log_file, workers)
+    data = log_file.read_bytes()
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == len(data)
+    for (_, end), (start, _) in zip(chunks, chunks[1:]):
+        assert end == start
+        assert data[start - 1 : start] == b"\n"
+    lines = sum(len(list(log_finder(log_file, start, end))) for start, end in chunks)
+    assert lines == 1000
+
+
+def test_aggregate_parallel(log_file):
+    serial = aggregate_parallel(log_file, 1)
+    parallel = aggregate_parallel(log_file, 4)
+    assert sorted(serial) == sorted(parallel)
+    for url, url_stats in serial.items():
+        assert parallel[url].count == url_stats.count
+        assert parallel[url].time_sum == pytest.approx(url_stats.time_sum)
+        assert parallel[url].time_max == url_stats.time_max
+        assert sorted(parallel[url].quantiles.times) == sorted(
+            url_stats.quantiles.times
+        )
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        (
+            LOG_LINE.format(url="/api/v2/banner/1", time="0.390"),
+            ("/api/v2/banner/1", 0.39),
+        ),
+        (LOG_LINE.format(url="/export/?a=1", time="12"), ("/export/?a=1", 12.0)),
+        (
+            '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /a"b HTTP/1.1" 200 0 "-" 0.5\n',
+            ("/a", 0.5),
+        ),
+    ],
+)
+def test_ui_short_parser(line, expected):
+    assert UiShortParser().parse(line.encode()) == expected
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "garbage\n",
+        '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "0" 400 0 "-" 0.001\n',
+        LOG_LINE.format(url="/api", time="-"),
+        LOG_LINE.format(url="/api", time="nan"),
+        LOG_LINE.format(url="/api", time="inf"),
+        LOG_LINE.format(url="/api", time="-1"),
+        LOG_LINE.format(url="/api", time="1e9"),
+        LOG_LINE.format(url="/api", time="1_000"),
+    ],
+)
+def test_ui_short_parser_invalid(line):
+    with pytest.raises(ValueError):
+        UiShortParser().parse(line.encode())
+
+
+@pytest.mark.parametrize("q", [0.01, 0.5, 0.9, 0.95, 0.99])
+def test_tdigest_quantile(q):
+    values = np.random.default_rng(0).lognormal(size=100000)
+    digest = TDigest()
+    for value in values[:50000]:
+        digest.add(value)
+    other = TDigest()
+    for value in values[50000:]:
+        other.add(value)
+    digest.merge(other)
+    assert len(digest.means) <= digest.compression
+    assert digest.quantile(q) == pytest.approx(np.quantile(values, q), rel=0.02)
+
+
+def test_build_report_tdigest():
+    report = build_report(aggregate([("/a", 1), ("/a", 2), ("/a", 3)], backend=TDigest))
+    assert report[0]["time_med"] == 2
+    assert sorted(key for key in report[0] if key.startswith("time_p9")) == [
+        "time_p90",
+        "time_p95",
+        "time_p99",
+    ]
+
+
+def test_log_reader(log_file, tmp_path):
+    gz_file = tmp_path / "nginx-access-ui.log-20170630.gz"
+    with gzip.open(gz_file, "wb") as f:
+        f.write(log_file.read_bytes())
+    expected = log_file.read_bytes().splitlines()
+    assert list(log_reader(log_file)) == expected
+    assert list(log_reader(gz_file)) == expected
+    end = len(expected[0]) + 1
+    assert list(log_reader(log_file, 0, end)) == expected[:1]
+    assert list(log_reader(log_file, 1, end + 1)) == [expected[0][1:], expected[1]]
+
+
+def test_log_reader_empty(tmp_path):
+    empty = tmp_path / "nginx-access-ui.log-20170630"
+    empty.touch()
+    assert list(log_reader(empty)) == []
+
+
+def test_aggregate_incremental(log_file, tmp_path):
+    data = log_file.read_bytes()
+    growing = tmp_path / "nginx-access-ui.log-20170701"
+    growing.write_bytes(data[:1000])
+    state_file = tmp_path / "state"
+    state = load_state(state_file)
+    aggregate_incremental(growing, state)
+    save_state(state_file, state)
+    assert state["current"]["offset"] == data.rindex(b"\n", 0, 1000) + 1
+
+    with open(growing, "ab") as f:
+        f.write(data[1000:])
+    state = load_state(state_file)
+    stats = aggregate_incremental(growing, state, workers=2)
+    expected = aggregate(log_finder(log_file))
+    assert {url: s.count for url, s in stats.items()} == {
+        url: s.count for url, s in expected.items()
+    }
+    assert state["processed"][str(growing)] == len(data)
+    assert is_processed(state, growing)
+    assert aggregate_incremental(growing, state) is stats
+
+    with open(growing, "ab") as f:
+        f.write(data[:1000])
+    assert not is_processed(state, growing)
+    assert not is_processed(state, log_file)
+
+
+def test_main_state_settings_changed(log_file, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "log").mkdir()
+    log_file.rename(tmp_path / "log" / log_file.name)
+    (tmp_path / "report.html").write_text("$table_json")
+    monkeypatch.setitem(config, "LOG_DIR", str(tmp_path / "log"))
+    monkeypatch.setitem(config, "STATE_FILE", str(tmp_path / "state"))
+    main()
+    report = json.loads((tmp_path / "report-20170630.html").read_text())
+    assert "time_p99" not in report[0]
+    assert len(report) == 7
+
+    monkeypatch.setitem(config, "QUANTILE_BACKEND", "tdigest")
+    monkeypatch.setitem(
+        config, "URL_NORMALIZATION", {"RULES": [["/banner/{id}", "/banner"]]}
+    )
+    main()
+    report = json.loads((tmp_path / "report-20170630.html").read_text())
+    assert "time_p99" in report[0]
+    assert [row["url"] for row in report] == ["/api/v2/banner"]
+    assert load_state(tmp_path / "state")["current"]["backend"] == "TDigest"
+
+
+@pytest.mark.parametrize(
+    "names, expected",
+    [
+        (
+            [
+                "nginx-access-ui.log-20170630",
+                "nginx-access-ui.log-20170701.gz",
+                "nginx-access-ui.log-20170702.bz2",
+                "nginx-access-ui.log-20171399",
+                "nginx-test-ui.log-20990101",
+                "zzz",
+            ],
+            ("nginx-access-ui.log-20170701.gz", "20170701"),
+        ),
+        (
+            ["nginx-access-ui.log-20170701.gz", "nginx-access-ui.log-20170701"],
+            ("nginx-access-ui.log-20170701", "20170701"),
+        ),
+        (["report.html"], None),
+    ],
+)
+def test_find_latest_log(tmp_path, names, expected):
+    for name in names:
+        (tmp_path / name).touch()
+    (tmp_path / "nginx-access-ui.log-20991231").mkdir()
+    latest = find_latest_log(str(tmp_path))
+    if expected is None:
+        assert latest is None
+    else:
+        assert (latest[0].name, latest[1]) == expected
+
+
+def test_build_report_size():
+    stats = aggregate([("/a", 1), ("/b", 3), ("/c", 2), ("/b", 1), ("/d", 3)])
+    report = build_report(stats, report_size=2)
+    assert [row["url"] for row in report] == ["/b", "/d"]
+    assert report[0]["time_perc"] == 40
+
+
+def test_dump_columnar(tmp_path):
+    report = build_report(aggregate([("/a", 1), ("/b", 3), ("/a", 2)]), report_size=10)
+    path = tmp_path / "report-20170630.npz"
+    dump_columnar(report, path)
+    assert load_columnar(path) == report
+
+
+def test_find_logs(tmp_path):
+    for name in [
+        "nginx-access-ui.log-20170628.gz",
+        "nginx-access-ui.log-20170629.gz",
+        "nginx-access-ui.log-20170629",
+        "nginx-access-ui.log-20170630",
+        "nginx-access-ui.log-20170701.gz",
+    ]:
+        (tmp_path / name).touch()
+    logs = find_logs(str(tmp_path), "20170629", "20170630")
+    assert [path.name for path in logs.values()] == [
+        "nginx-access-ui.log-20170629",
+        "nginx-access-ui.log-20170630",
+    ]
+    assert list(find_logs(str(tmp_path), date_from="20170630")) == [
+        "20170630",
+        "20170701",
+    ]
+
+
+def test_analyze_range(log_file, tmp_path):
+    data = log_file.read_bytes()
+    (tmp_path / "nginx-access-ui.log-20170701").write_bytes(
+        data[: data.index(b"\n") + 1]
+    )
+    with gzip.open(tmp_path / "nginx-access-ui.log-20170702.gz", "wb") as f:
+        f.write(data)
+    daily, merged = analyze_range(str(tmp_path), "20170630", "20170702", workers=3)
+    assert list(daily) == ["20170630", "20170701", "20170702"]
+    assert sum(url_stats.count for url_stats in merged.values()) == 2001
+    assert sum(url_stats.count for url_stats in daily["20170630"].values()) == 1000
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_analyze_range_skips_broken_day(log_file, tmp_path, workers):
+    (tmp_path / "nginx-access-ui.log-20170701").write_text("garbage\n" * 2000)
+    (tmp_path / "nginx-access-ui.log-20170702").write_bytes(log_file.read_bytes())
+    daily, merged = analyze_range(str(tmp_path), None, None, workers=workers)
+    assert list(daily) == ["20170630", "20170702"]
+    assert sum(url_stats.count for url_stats in merged.values()) == 2000
+
+
+def test_render_report(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "template.html").write_text("<script>var table = $table_json;</script>")
+    report = [{"url": f"/api/{i}", "time_med": None} for i in range(2500)]
+    render_report("20170630", report, template="template.html")
+    assert sorted(os.listdir(tmp_path)) == ["report-20170630.html", "template.html"]
+    html = (tmp_path / "report-20170630.html").read_text()
+    assert html.startswith("<script>var table = [")
+    assert html.endswith("];</script>")
+    assert json.loads(html[len("<script>var table = ") : -len(";</script>")]) == report
+
+
+def test_render_report_escapes_urls(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "report.html").write_text("<script>var table = $table_json;</script>")
+    report = [{"url": "/</script><script>alert(1)</script>&", "time_med": 0.1}]
+    render_report("20170630", report)
+    html = (tmp_path / "report-20170630.html").read_text()
+    assert html.count("</script>") == 1
+    assert "<script>alert" not in html
+    assert json.loads(html[len("<script>var table = ") : -len(";</script>")]) == report
+
+
+def test_render_report_template_changed(tmp_path, monkeypatch):
+    for name in ("first", "second"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "report.html").write_text(f"{name} $table_json")
+    monkeypatch.chdir(tmp_path / "first")
+    render_report("20170630", [])
+    assert (tmp_path / "first" / "report-20170630.html").read_text() == "first []"
+    monkeypatch.chdir(tmp_path / "second")
+    render_report("20170630", [])
+    assert (tmp_path / "second" / "report-20170630.html").read_text() == "second []"
+
+    template = tmp_path / "second" / "report.html"
+    template.write_text("edited $table_json")
+    os.utime(template, ns=(0, template.stat().st_mtime_ns + 1_000_000_000))
+    render_report("20170630", [])
+    assert (tmp_path / "second" / "report-20170630.html").read_text() == "edited []"
+
+
+def test_rolling_stats():
+    rolling = RollingStats()
+    for minute in range(20):
+        rolling.add("/a", 1.0, now=minute * 60)
+    rolling.add("/b", 3.0, now=19 * 60 + 30)
+    snapshot = rolling.snapshot(now=19 * 60 + 59)
+    counts = {
+        window: {row["url"]: row["count"] for row in rows}
+        for window, rows in snapshot.items()
+    }
+    assert counts == {
+        "1m": {"/a": 1, "/b": 1},
+        "5m": {"/a": 5, "/b": 1},
+        "15m": {"/a": 15, "/b": 1},
+    }
+    assert len(rolling.buckets) == 15
+    assert snapshot["1m"][1]["time_p99"] == 3
+
+
+def test_log_tailer(tmp_path):
+    first = tmp_path / "nginx-access-ui.log-20170630"
+    first.write_bytes(b"old\n")
+    tailer = LogTailer(str(tmp_path))
+    assert tailer.read_lines() == []
+    with open(first, "ab") as f:
+        f.write(b"line 1\nline")
+    assert tailer.read_lines() == [b"line 1"]
+    with open(first, "ab") as f:
+        f.write(b" 2\nline 3")
+    (tmp_path / "nginx-access-ui.log-20170701").write_bytes(b"new 1\nnew")
+    assert tailer.read_lines() == [b"line 2", b"line 3", b"new 1"]
+    assert tailer.path.name == "nginx-access-ui.log-20170701"
+    tailer.close()
+
+
+@pytest.fixture()
+def gz_log_file(log_file, tmp_path):
+    path = tmp_path / "nginx-access-ui.log-20170630.gz"
+    with gzip.open(path, "wb") as f:
+        f.write(log_file.read_bytes())
+    return path
+
+
+def test_gzip_blocks(log_file, gz_log_file):
+    blocks = list(gzip_blocks(gz_log_file, block_size=1000, queue_size=2))
+    assert max(len(block) for block in blocks) == 1000
+    assert b"".join(blocks) == log_file.read_bytes()
+    reader = gzip_blocks(gz_log_file, block_size=10, queue_size=1)
+    next(reader)
+    reader.close()
+    assert [thread.name for thread in threading.enumerate()].count("gzip-reader") == 0
+
+
+def test_aggregate_parallel_gz(log_file, gz_log_file):
+    serial = aggregate_parallel(log_file, 1)
+    parallel = aggregate_parallel(gz_log_file, 3)
+    assert {url: s.count for url, s in parallel.items()} == {
+        url: s.count for url, s in serial.items()
+    }
+
+
+@pytest.mark.parametrize(
+    "normalizer, url, expected",
+    [
+        (UrlNormalizer(), "/api/v2/banner/25019354", "/api/v2/banner/{id}"),
+        (
+            UrlNormalizer(),
+            "/api/v2/group/7786679/statistic/?date=1",
+            "/api/v2/group/{id}/statistic/",
+        ),
+        (
+            UrlNormalizer(),
+            "/api/v1/photo/3f2504e0-4f89-11d3-9a0c-0305e82c3301/",
+            "/api/v1/photo/{uuid}/",
+        ),
+        (UrlNormalizer(), "/export/2017-06-30/v2", "/export/2017-06-30/v2"),
+        (UrlNormalizer(strip_query=False), "/a/1?id=2", "/a/{id}?id=2"),
+        (UrlNormalizer(template_ids=False), "/a/1?id=2", "/a/1"),
+        (
+            UrlNormalizer(rules=[[r"/export/[0-9-]+/", "/export/{date}/"]]),
+            "/export/2017-06-30/",
+            "/export/{date}/",
+        ),
+    ],
+)
+def test_url_normalizer(normalizer, url, expected):
+    assert normalizer.normalize(url) == expected
+
+
+def test_get_normalizer():
+    assert get_normalizer({"URL_NORMALIZATION": None}) is None
+    assert get_normalizer({"URL_NORMALIZATION": False}) is None
+    normalizer = get_normalizer({"URL_NORMALIZATION": {}})
+    assert normalizer.key == UrlNormalizer().key
+    normalizer = get_normalizer({"URL_NORMALIZATION": {"TEMPLATE_IDS": False}})
+    assert normalizer.normalize("/a/1?id=2") == "/a/1"
+
+
+def test_aggregate_parallel_normalized(log_file):
+    normalizer = UrlNormalizer(cache_size=2)
+    stats = aggregate_parallel(log_file, 3, normalizer=normalizer)
+    assert {url: s.count for url, s in stats.items()} == {"/api/v2/banner/{id}": 1000}
+
+
+@pytest.mark.parametrize(
+    "bad_every, lines, expected_lines",
+    [
+        (1, 5000, 0),
+        (3, 5000, 3333),
+        (4, 5000, 3750),
+    ],
+)
+def test_log_finder_errors(tmp_path, bad_every, lines, expected_lines, caplog):
+    path = tmp_path / "nginx-access-ui.log-20170630"
+    with open(path, "w") as f:
+        for i in range(lines):
+            if i % bad_every == 0:
+                f.write("garbage\n")
+            else:
+                f.write(LOG_LINE.format(url="/api", time=0.1))
+    errors = ParseErrors(sample_size=3)
+    if bad_every == 1:
+        with pytest.raises(TooManyParseErrors):
+            list(log_finder(path, errors=errors))
+    else:
+        assert len(list(log_finder(path, errors=errors))) == expected_lines
+    assert len(errors.examples) == 3
+    assert len([r for r in caplog.records if "Не удалось разобрать" in r.message]) == 3
+    if bad_every == 1:
+        assert errors.lines == ERRORS_MIN_LINES
+    else:
+        assert errors.lines == lines
+
+
+def test_log_finder_errors_at_eof(tmp_path):
+    path = tmp_path / "nginx-access-ui.log-20170630"
+    path.write_text("garbage\n" * 900 + LOG_LINE.format(url="/api", time=0.1) * 10)
+    errors = ParseErrors()
+    with pytest.raises(TooManyParseErrors):
+        list(log_finder(path, errors=errors))
+    assert (errors.lines, errors.errors) == (910, 900)
+    assert log_analyzer(path) is None
+
+    state = load_state(tmp_path / "state")
+    with pytest.raises(TooManyParseErrors):
+        aggregate_incremental(path, state)
+    assert state == {"processed": {}, "current": None}
+    assert log_analyzer(path, state=state) is None
+    assert state == {"processed": {}, "current": None}
+
+
+def test_log_finder_first_line_error(tmp_path):
+    path = tmp_path / "nginx-access-ui.log-20170630"
+    path.write_text("garbage\n" + LOG_LINE.format(url="/api", time=0.1) * 10)
+    assert len(list(log_finder(path))) == 10
+
+
+@pytest.mark.parametrize("value", ["2017-06-30", "2017063", "20171399", "today"])
+def test_log_date_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        log_date(value)
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--date-from", value])
+
+
+def test_log_date():
+    assert log_date("20170630") == "20170630"
+    assert parser.parse_args(["--date-to", "20170630"]).date_to == "20170630"
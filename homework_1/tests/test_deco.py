@@ -0,0 +1,450 @@
+import asyncio
+import inspect
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+import numpy as np
+import pytest
+
+from .. import deco
+from ..deco import countcalls, memo, n_ary, profile, profile_report, trace, Switch
+
+
+def test_memo_shared_cache():
+    calls = []
+
+    @memo
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert [square(3), square(3), square(4)] == [9, 9, 16]
+    assert calls == [3, 4]
+    info = square.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.currsize) == (1, 2, 0, 2)
+    square.cache_clear()
+    assert square.cache_info().currsize == 0
+
+
+def test_memo_fib_linear():
+    calls = []
+
+    @memo
+    def fib(n):
+        calls.append(n)
+        return 1 if n <= 1 else fib(n - 1) + fib(n - 2)
+
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(10000)
+    try:
+        fib(1000)
+    finally:
+        sys.setrecursionlimit(limit)
+    assert sorted(calls) == list(range(1001))
+    assert fib.cache_info().hits == 998
+
+
+def test_memo_lru():
+    @memo(maxsize=2)
+    def identity(x):
+        return x
+
+    for x in (1, 2, 1, 3):
+        identity(x)
+    info = identity.cache_info()
+    assert (info.misses, info.evictions, info.maxsize, info.currsize) == (3, 1, 2, 2)
+    identity(1)
+    assert identity.cache_info().hits == 2
+    identity(2)
+    assert identity.cache_info().misses == 4
+
+
+def test_memo_ttl(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    @memo(ttl=10)
+    def identity(x):
+        return x
+
+    identity(1)
+    now[0] = 5
+    identity(1)
+    now[0] = 11
+    identity(1)
+    info = identity.cache_info()
+    assert (info.hits, info.misses, info.evictions) == (1, 2, 1)
+
+
+def test_memo_kwargs_and_unhashable():
+    calls = []
+
+    @memo
+    def total(items, scale=1):
+        calls.append(items)
+        return sum(items) * scale
+
+    assert total([1, 2]) == total([1, 2]) == 3
+    assert total((1, 2)) == 3
+    assert total([1, 2], scale=2) == total([1, 2], scale=2) == 6
+    assert len(calls) == 3
+
+    @memo
+    def name(value):
+        return type(value).__name__
+
+    class Unhashable:
+        __hash__ = None
+
+    assert name(Unhashable()) == name(Unhashable()) == "Unhashable"
+    assert name.cache_info().currsize == 0
+
+
+@pytest.mark.parametrize("maxsize", [None, 1024])
+def test_memo_keeps_metadata(maxsize):
+    @memo(maxsize=maxsize)
+    def documented():
+        """Some doc"""
+
+    assert documented.__name__ == "documented"
+    assert documented.__doc__ == "Some doc"
+
+
+def test_countcalls_through_memo():
+    @memo
+    @countcalls
+    def add(a, b):
+        return a + b
+
+    add(1, 2)
+    add(1, 2)
+    add(2, 3)
+    assert add.calls == 2
+    assert add.cache_info().hits == 1
+    assert add.__name__ == "add"
+
+
+def test_countcalls_independent_wrappers():
+    def add(a, b):
+        return a + b
+
+    first, second = countcalls(add), countcalls(add)
+    first(1, 2)
+    assert (first.calls, second.calls) == (1, 0)
+    assert not hasattr(add, "calls")
+
+    nested = countcalls(countcalls(add))
+    nested(1, 2)
+    assert nested.calls == nested.__wrapped__.calls == 1
+
+
+def test_countcalls_is_int():
+    @trace("..")
+    @memo
+    @countcalls
+    def identity(x):
+        return x
+
+    identity(1)
+    identity(2)
+    assert type(identity.calls) is int
+    assert identity.calls + 1 == 3
+    assert identity.calls > 0
+    assert json.dumps({"calls": identity.calls}) == '{"calls": 2}'
+    assert {identity.calls: "two"}[2] == "two"
+
+
+def test_memo_independent_wrappers():
+    def identity(x):
+        return x
+
+    first, second = memo(identity), memo(identity, maxsize=2)
+    first(1)
+    first(1)
+    assert first.cache_info().hits == 1
+    assert second.cache_info().hits == second.cache_info().currsize == 0
+    assert second.cache_info().maxsize == 2
+    assert not hasattr(identity, "cache_info")
+
+
+def test_wrappers_keep_signature():
+    def scale(x, factor=2):
+        return x * factor
+
+    wrapped = memo(countcalls(trace("..")(scale)))
+    assert inspect.signature(wrapped) == inspect.signature(scale)
+    assert inspect.unwrap(wrapped) is scale
+
+
+@pytest.fixture
+def profiling(monkeypatch):
+    monkeypatch.setattr(deco.PROFILING, "enabled", True)
+
+
+def test_profile(profiling):
+    @profile
+    def inner():
+        time.sleep(0.01)
+
+    @profile
+    def outer(n):
+        inner()
+        return outer(n - 1) if n else None
+
+    outer(2)
+    assert (outer.stats.calls, inner.stats.calls) == (3, 3)
+    assert inner.stats.self_ns >= 30_000_000
+    assert outer.stats.total_ns >= inner.stats.total_ns
+    assert outer.stats.self_ns < inner.stats.self_ns
+    assert outer.stats.self_ns + inner.stats.self_ns <= outer.stats.total_ns * 1.01
+    assert profile_report().index(inner.stats) < profile_report().index(outer.stats)
+
+
+def test_profile_threads(profiling):
+    @profile
+    def handler():
+        time.sleep(0.1)
+
+    threads = [threading.Thread(target=handler) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert handler.stats.calls == 4
+    assert handler.stats.total_ns >= 400_000_000
+    assert handler.stats.self_ns == handler.stats.total_ns
+
+
+def test_profile_disabled():
+    @profile
+    def identity(x):
+        return x
+
+    identity(1)
+    assert identity.stats.calls == 0
+    overhead = min(timeit.repeat(lambda: identity(1), number=100000, repeat=5))
+    assert overhead / 100000 < 1e-6
+
+
+def test_trace(capsys):
+    @trace("__")
+    def fib(n):
+        return 1 if n <= 1 else fib(n - 1) + fib(n - 2)
+
+    assert fib(2) == 2
+    assert capsys.readouterr().out.splitlines() == [
+        " --> fib(2)",
+        "__ --> fib(1)",
+        "__ <-- fib(1) == 1",
+        "__ --> fib(0)",
+        "__ <-- fib(0) == 1",
+        " <-- fib(2) == 2",
+    ]
+
+
+def test_trace_sampling_and_switch(capsys):
+    switch = Switch(True)
+
+    @trace("..", every=2, switch=switch)
+    def square(x, power=2):
+        return x**power
+
+    for x in range(4):
+        square(x, power=2)
+    assert capsys.readouterr().out.splitlines() == [
+        " --> square(0, power=2)",
+        " <-- square(0, power=2) == 0",
+        " --> square(2, power=2)",
+        " <-- square(2, power=2) == 4",
+    ]
+    switch.enabled = False
+    square(4)
+    assert capsys.readouterr().out == ""
+
+
+def run_threads(target, count):
+    barrier = threading.Barrier(count)
+    results = []
+
+    def run():
+        barrier.wait()
+        try:
+            results.append(target())
+        except ValueError as error:
+            results.append(error)
+
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@pytest.mark.parametrize("ttl", [None, 1e-6])
+def test_memo_plain_threads(ttl):
+    """Без threadsafe=True гонки между потоками не доходят до вызывающего"""
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    @memo(maxsize=4, ttl=ttl)
+    def double(x):
+        return x * 2
+
+    def calls():
+        keys = [random.randrange(6) for _ in range(20000)]
+        return all(double(key) == key * 2 for key in keys)
+
+    try:
+        assert run_threads(calls, 8) == [True] * 8
+    finally:
+        sys.setswitchinterval(interval)
+    assert double.cache_info().currsize <= 6
+
+
+def test_memo_threadsafe_single_flight():
+    calls = []
+
+    @memo(threadsafe=True)
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.05)
+        return x * 2
+
+    assert run_threads(lambda: slow(21), 16) == [42] * 16
+    assert calls == [21]
+    info = slow.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (15, 1, 1)
+
+
+def test_memo_threadsafe_errors_not_cached():
+    calls = []
+
+    @memo(threadsafe=True)
+    def failing(x):
+        calls.append(x)
+        time.sleep(0.05)
+        raise ValueError(x)
+
+    results = run_threads(lambda: failing(1), 8)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert calls == [1]
+    with pytest.raises(ValueError):
+        failing(1)
+    assert calls == [1, 1]
+    assert failing.cache_info().currsize == 0
+
+
+def test_memo_threadsafe_recursion():
+    @memo(threadsafe=True)
+    def fib(n):
+        return 1 if n <= 1 else fib(n - 1) + fib(n - 2)
+
+    assert fib(200) == 453973694165307953197296969697410619233826
+    assert fib.cache_info().misses == 201
+
+
+def test_memo_async_shared_future():
+    calls = []
+
+    @memo
+    async def fetch(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x + 1
+
+    async def main():
+        results = await asyncio.gather(*(fetch(1) for _ in range(10)), fetch(2))
+        return results + [await fetch(1)]
+
+    assert asyncio.run(main()) == [2] * 10 + [3, 2]
+    assert sorted(calls) == [1, 2]
+    info = fetch.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (10, 2, 2)
+
+
+def test_memo_async_errors_and_cancel():
+    calls = []
+
+    @memo
+    async def fetch(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        if x < 0:
+            raise ValueError(x)
+        return x
+
+    async def main():
+        results = await asyncio.gather(fetch(-1), fetch(-1), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        waiter = asyncio.ensure_future(fetch(5))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        assert await fetch(5) == 5
+
+    asyncio.run(main())
+    assert calls == [-1, 5]
+    assert fetch.cache_info().currsize == 1
+
+
+def test_memo_async_threadsafe_rejected():
+    async def fetch(x):
+        return x
+
+    with pytest.raises(ValueError):
+        memo(fetch, threadsafe=True)
+
+
+def test_n_ary_right_fold():
+    calls = []
+
+    @n_ary
+    def sub(a, b):
+        calls.append((a, b))
+        return a - b
+
+    assert sub(5) == 5
+    assert sub(10, 3) == 7
+    assert sub(10, 3, 2) == 10 - (3 - 2)
+    assert calls[-2:] == [(3, 2), (10, 1)]
+    assert sub.__name__ == "sub"
+
+
+def test_n_ary_stack_safe():
+    add = n_ary(lambda a, b: a + b)
+    values = list(range(sys.getrecursionlimit() * 5))
+    assert add(*values) == sum(values)
+
+
+@pytest.mark.parametrize("associative", [True, "tree"])
+def test_n_ary_associative(associative):
+    concat = n_ary(lambda a, b: a + b, associative=associative)
+    words = [str(i) for i in range(1001)]
+    assert concat(*words) == "".join(words)
+    assert concat("a", "b") == "ab"
+
+
+def test_deco_does_not_import_numpy():
+    code = "import sys, deco; sys.exit('numpy' in sys.modules)"
+    cwd = os.path.dirname(deco.__file__)
+    assert subprocess.run([sys.executable, "-c", code], cwd=cwd).returncode == 0
+
+
+def test_n_ary_ufunc():
+    add = n_ary(np.add)
+    assert add(*range(10000)) == sum(range(10000))
+    arrays = [np.arange(3) * i for i in range(4)]
+    assert add(*arrays).tolist() == [0, 6, 12]
+    assert n_ary(np.subtract)(10, 3, 2) == 9
+    assert n_ary(np.maximum)(3, 7, 5) == 7
+    assert add([1], [1, 2], [3]).tolist() == [5, 6]
+    assert add(True, True, True) is np.True_
+    assert add(np.int8(100), np.int8(100), np.int8(100)) == np.int8(44)
+    assert add(np.int8(100), np.int8(100), np.int8(100)).dtype == np.int8
+    assert n_ary(np.logical_and)(1, 2, 0) is np.False_
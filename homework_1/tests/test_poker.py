@@ -0,0 +1,372 @@
+import os
+import random
+from itertools import combinations, islice, product
+
+import numpy as np
+import pytest
+
+from .. import poker
+from ..poker import (
+    batch_tables,
+    best_hand,
+    best_wild_hand,
+    canonical_matchup,
+    decode_card,
+    encode_card,
+    encode_hands,
+    equity,
+    fast_hand_rank,
+    freeze,
+    hand_rank,
+    iter_equity,
+    matchup_counts,
+    matchup_equity,
+    parse_range,
+    range_equity,
+    rank_hands,
+    ENCODED,
+    HAND_RANKS,
+    JOKERS,
+)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Таблицы и счетчики матчей пишутся во временный каталог, а не в ~/.cache"""
+    monkeypatch.setattr(poker, "RANK_TABLE_FILE", str(tmp_path / "ranks.npy"))
+    monkeypatch.setattr(poker, "MATCHUP_DIR", str(tmp_path / "matchups"))
+    return tmp_path
+
+
+@pytest.mark.parametrize(
+    "hand, expected",
+    [
+        ("AS KS QS JS TS", (8, 14)),
+        ("5D 4D 3D 2D AD", (8, 5)),
+        ("7C 7D 7H 7S JD", (7, 7, 11)),
+        ("TD TC TH 8C 8S", (6, 10, 8)),
+        ("6C 7C 8C 9C JC", (5, [11, 9, 8, 7, 6])),
+        ("AS 2D 3C 4H 5S", (4, 5)),
+        ("7C 7D 7H 2S JD", (3, 7, [11, 7, 7, 7, 2])),
+        ("7C 7D 2H 2S JD", (2, (7, 2), [11, 7, 7, 2, 2])),
+        ("7C 7D 3H 2S JD", (1, 7, [11, 7, 7, 3, 2])),
+        ("7C 9D 3H 2S JD", (0, [11, 9, 7, 3, 2])),
+    ],
+)
+def test_hand_rank(hand, expected):
+    assert hand_rank(hand.split()) == expected
+
+
+def test_encode_card():
+    assert all(decode_card(encode_card(card)) == card for card in ENCODED)
+
+
+def test_fast_hand_rank():
+    random.seed(0)
+    deck = list(ENCODED)
+    hands = [random.sample(deck, 5) for _ in range(20000)]
+    hands += [hand.split() for hand in ("AS KS QS JS TS", "5D 4D 3D 2D AD")]
+    for hand in hands:
+        assert HAND_RANKS[fast_hand_rank(hand)] == freeze(hand_rank(hand))
+    assert len(HAND_RANKS) == 7463
+    assert HAND_RANKS[1:] == sorted(HAND_RANKS[1:])
+
+
+def test_best_hand_examples():
+    poker.test_best_hand()
+
+
+@pytest.mark.parametrize(
+    "hand",
+    [
+        "AS 2S 3S 4S 5S 6S 7D",
+        "AS 2D 3S 4H 5S KS QS",
+        "TD TC TH 7C 7D 7S 8S",
+        "2C 2D 2H 3S 3C AS AD",
+        "9H 9S 9D 9C AH AS AD",
+        "KH QH 2H 3H 9H JD TS",
+        "AS AD KS KD QS QD 2C",
+    ],
+)
+def test_best_hand_special(hand):
+    hand = hand.split()
+    expected = max(combinations(hand, 5), key=hand_rank)
+    assert hand_rank(best_hand(hand)) == hand_rank(expected)
+
+
+def test_best_hand_random():
+    random.seed(0)
+    deck = list(ENCODED)
+    for _ in range(5000):
+        hand = random.sample(deck, 7)
+        best = best_hand(hand)
+        assert len(best) == 5 and set(best) <= set(hand)
+        assert fast_hand_rank(best) == max(map(fast_hand_rank, combinations(hand, 5)))
+
+
+def brute_force_wild_hand(hand):
+    """Полный перебор замен джокеров картами своего цвета, которых нет на руке"""
+    options = [
+        (
+            [card]
+            if card not in JOKERS
+            else [
+                rank + suit
+                for rank in poker.RANKS
+                for suit in JOKERS[card]
+                if rank + suit not in hand
+            ]
+        )
+        for card in hand
+    ]
+    return max(
+        hand_rank(best_hand(list(variant)))
+        for variant in product(*options)
+        if len(set(variant)) == len(variant)
+    )
+
+
+def test_best_wild_hand_examples():
+    poker.test_best_wild_hand()
+
+
+@pytest.mark.parametrize(
+    "hand",
+    [
+        "AS AC AH AD ?B ?R 2C",
+        "KS KC QS QC ?B 2H 3D",
+        "2H 3H 4H 5D 9C ?R ?B",
+        "AH KH QH JD 2C 3S ?R",
+        "7S 8S 9S 7C 8C ?B ?R",
+    ],
+)
+def test_best_wild_hand_special(hand):
+    hand = hand.split()
+    assert hand_rank(best_wild_hand(hand)) == brute_force_wild_hand(hand)
+
+
+def test_best_wild_hand_random():
+    random.seed(0)
+    deck = list(ENCODED)
+    for _ in range(300):
+        jokers = random.choice([["?B"], ["?R"], ["?B", "?R"]])
+        hand = random.sample(deck, 7 - len(jokers)) + jokers
+        best = best_wild_hand(hand)
+        substitutes = set(best) - set(hand)
+        assert len(set(best)) == 5 and len(substitutes) <= len(jokers)
+        assert all(
+            any(card[1] in JOKERS[joker] for joker in jokers) for card in substitutes
+        )
+        assert hand_rank(best) == brute_force_wild_hand(hand)
+
+
+def test_rank_hands():
+    random.seed(0)
+    deck = list(ENCODED)
+    hands = [random.sample(deck, 7) for _ in range(5000)]
+    hands += [
+        hand.split()
+        for hand in (
+            "AS KS QS JS TS 2D 3D",
+            "AH 2H 3H 4H 5H 6H 7H",
+            "AS AD AC AH KS KD 2C",
+            "2C 2D 2H 3S 3C 3H 4D",
+        )
+    ]
+    ranks = rank_hands(encode_hands(hands))
+    assert ranks.shape == (len(hands),)
+    assert ranks.tolist() == [fast_hand_rank(best_hand(hand)) for hand in hands]
+
+
+@pytest.mark.parametrize(
+    "hands",
+    [
+        encode_hands(["AS AH AD AC KS 2D".split()]),
+        encode_hands(["AS KS QS JS TS 2D 3D".split()])[0],
+        encode_hands(["AS AS QS JS TS 2D 3D".split()]),
+        encode_hands(["AS KS QS JS TS 2D 3D".split()]) + 1,
+        np.zeros((1, 7), dtype=np.int64),
+    ],
+)
+def test_rank_hands_errors(hands):
+    with pytest.raises(ValueError):
+        rank_hands(hands)
+
+
+def test_equity_exact():
+    hole, board = "AS KS".split(), "QS JS 2D 5H 9C".split()
+    rest = [card for card in ENCODED if card not in hole + board]
+    hero = hand_rank(best_hand(hole + board))
+    results = [
+        (hero > rival) - (hero < rival)
+        for rival in (
+            hand_rank(best_hand(list(pair) + board)) for pair in combinations(rest, 2)
+        )
+    ]
+    estimate = equity(hole, board)
+    assert estimate.trials == len(results) == 990
+    assert estimate.win == pytest.approx(results.count(1) / 990)
+    assert estimate.tie == pytest.approx(results.count(0) / 990)
+    assert estimate.loss == pytest.approx(results.count(-1) / 990)
+    assert estimate.margin == 0
+
+
+def test_equity_sampled():
+    estimate = equity("AS AD".split(), trials=50000)
+    assert estimate.trials == 50000
+    assert estimate.win + estimate.tie + estimate.loss == pytest.approx(1)
+    assert abs(estimate.equity - 0.852) < 3 * estimate.margin
+    assert equity("AS AD".split(), trials=50000) == estimate
+    assert equity("AS AD".split(), trials=50000, workers=2) == estimate
+    assert equity("AS AD".split(), trials=50000, seed=1) != estimate
+
+
+def test_equity_margin():
+    estimates = list(islice(iter_equity("7C 2D".split(), opponents=3, trials=None), 5))
+    assert [estimate.trials for estimate in estimates] == [
+        10000 * i for i in range(1, 6)
+    ]
+    assert estimates[-1].margin < estimates[0].margin
+    estimate = equity("7C 2D".split(), opponents=3, trials=None, margin=0.005)
+    assert estimate.margin <= 0.005
+
+
+def test_equity_errors():
+    with pytest.raises(ValueError):
+        equity("AS AS".split())
+    with pytest.raises(ValueError):
+        equity("AS KD".split(), opponents=24)
+    for trials in (0, -1):
+        with pytest.raises(ValueError):
+            equity("AS KD".split(), trials=trials)
+
+
+@pytest.mark.parametrize(
+    "text, size",
+    [
+        ("QQ+", 18),
+        ("AKs", 4),
+        ("AKo", 12),
+        ("AK", 16),
+        ("QQ+, AKs", 22),
+        ("A2s+", 48),
+        ("22-55", 24),
+        ("A2s-A5s", 16),
+        ("AhKh, AKs", 4),
+        ("22+, 22", 78),
+    ],
+)
+def test_parse_range(text, size):
+    combos = parse_range(text)
+    assert len(combos) == size == len(set(combos))
+    assert all(len(set(combo)) == 2 and set(combo) <= set(ENCODED) for combo in combos)
+
+
+@pytest.mark.parametrize("text", ["AKx", "QQ+s", "AK-QJ", "22-AKs", "XX"])
+def test_parse_range_errors(text):
+    with pytest.raises(ValueError):
+        parse_range(text)
+
+
+def test_matchup_equity():
+    hole, rival, board = ("AS", "AH"), ("KD", "QD"), ("JD", "TD", "2C")
+    rest = [card for card in ENCODED if card not in hole + rival + board]
+    results = []
+    for runout in combinations(rest, 2):
+        table = list(board + runout)
+        hero = hand_rank(best_hand(list(hole) + table))
+        other = hand_rank(best_hand(list(rival) + table))
+        results.append((hero > other) - (hero < other))
+    estimate = matchup_equity(hole, rival, board)
+    assert estimate.trials == len(results)
+    assert estimate.win == pytest.approx(results.count(1) / len(results))
+    assert estimate.tie == pytest.approx(results.count(0) / len(results))
+    assert matchup_equity(("AC", "AD"), ("KH", "QH"), ("JH", "TH", "2S")) == estimate
+
+
+def test_matchup_equity_river():
+    hole, rival = ("AS", "AH"), ("KC", "KH")
+    board = ["2C", "7D", "9H", "KS", "3D"]
+    estimate = matchup_equity(hole, rival, board)
+    assert (estimate.trials, estimate.win, estimate.tie) == (1, 0.0, 0.0)
+    result = range_equity("AA", "KK", board)
+    assert len(result) == 6
+    assert all(equity.win == 0.0 for equity in result.values())
+
+
+def test_canonical_matchup():
+    assert canonical_matchup(("AS", "AH"), ("KS", "KH")) == canonical_matchup(
+        ("AD", "AC"), ("KC", "KD")
+    )
+    assert canonical_matchup(("AS", "AH"), ("KS", "KH")) != canonical_matchup(
+        ("AS", "AH"), ("KD", "KC")
+    )
+
+
+def test_range_equity():
+    board = ("2C", "7D", "9H", "JS")
+    result = range_equity("QQ+", "AKs, 77", board)
+    assert len(result) == 18
+    for hole, estimate in result.items():
+        rivals = [
+            rival
+            for rival in parse_range("AKs, 77")
+            if not set(rival) & set(hole + board)
+        ]
+        counts = [matchup_equity(hole, rival, board) for rival in rivals]
+        assert estimate.trials == sum(count.trials for count in counts)
+        assert estimate.win == pytest.approx(
+            sum(count.win * count.trials for count in counts) / estimate.trials
+        )
+
+
+def test_rank_table_file(tmp_path, monkeypatch):
+    path = tmp_path / "cache" / "ranks.npy"
+    monkeypatch.setattr(poker, "RANK_TABLE_FILE", str(path))
+    batch_tables.cache_clear()
+    try:
+        built = batch_tables()
+        assert path.exists()
+        batch_tables.cache_clear()
+        loaded = batch_tables()
+        assert isinstance(loaded[0].base, np.memmap) or isinstance(loaded[0], np.memmap)
+        assert all((a == b).all() for a, b in zip(built, loaded))
+
+        stale = np.load(path)
+        stale[100] += 1
+        np.save(path, stale)
+        batch_tables.cache_clear()
+        assert all((a == b).all() for a, b in zip(built, batch_tables()))
+        assert (np.load(path) == np.concatenate(built)).all()
+    finally:
+        batch_tables.cache_clear()
+
+
+def test_matchup_counts_file(cache_dir):
+    key = canonical_matchup(("AS", "AH"), ("KD", "QD"), ("JD", "TD", "2C"))
+    matchup_counts.cache_clear()
+    try:
+        counts = matchup_counts(key)
+        files = list((cache_dir / "matchups").iterdir())
+        assert len(files) == 1
+        assert (np.load(files[0]) == counts).all()
+
+        np.save(files[0], counts * 2)
+        matchup_counts.cache_clear()
+        assert (matchup_counts(key) == counts * 2).all()
+
+        files[0].write_bytes(b"garbage")
+        matchup_counts.cache_clear()
+        assert (matchup_counts(key) == counts).all()
+        assert (np.load(files[0]) == counts).all()
+    finally:
+        matchup_counts.cache_clear()
+
+
+def test_rank_table_location(monkeypatch):
+    monkeypatch.undo()
+    assert os.path.basename(poker.CACHE_DIR) == "poker"
+    assert os.path.dirname(poker.RANK_TABLE_FILE) == poker.CACHE_DIR
+    assert os.path.dirname(poker.MATCHUP_DIR) == poker.CACHE_DIR
+    assert poker.RANK_TABLE_SHA256[:16] in os.path.basename(poker.RANK_TABLE_FILE)
+    assert poker.RANK_TABLE_SHA256[:16] in os.path.basename(poker.MATCHUP_DIR)